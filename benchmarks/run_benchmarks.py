@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark the stages of the Kadi -> quality check -> crawler pipeline with synthetic records.
+
+Kadi, GitLab and S3 are replaced by local stand-ins (see ``stubs.py``).  The crawler stages
+(``scan_validate`` and ``trigger_crawler``) need a LinkAhead server, configured as usual in
+``pylinkahead.ini``.  A stage which cannot run is reported with its error, the other stages are run
+nevertheless.
+
+Example::
+
+  python benchmarks/run_benchmarks.py --records 20 --files 5 --file-size 1000000 -o results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import traceback
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Optional
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from stubs import S3Server, StubServer, gitlab_handler, kadi_handler  # noqa: E402
+from synthetic import Shape, make_records, make_report  # noqa: E402
+
+STAGES = ("kadi_collect", "kadi_download", "qc_upload", "qc_cleanup", "qc_check", "scan_validate",
+          "trigger_crawler")
+
+
+@contextmanager
+def _working_dir(path: str):
+    """Change the working directory temporarily, QualityChecker reads its config from there."""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _timed(func: Callable[[], Optional[dict]], repeat: int, n_records: int) -> dict:
+    """Run ``func`` ``repeat`` times and summarize the durations."""
+    times = []
+    extra: dict = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        extra = func() or {}
+        times.append(time.perf_counter() - start)
+    return {
+        "times": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "per_record": statistics.median(times) / max(n_records, 1),
+        **extra,
+    }
+
+
+class Benchmarks:
+    """The benchmarked stages, sharing one set of synthetic records and stand-ins."""
+
+    def __init__(self, workdir: str, records: list[tuple[int, datetime]], shape: Shape,
+                 kadi_url: str, gitlab_url: str, s3: S3Server):
+        self.workdir = workdir
+        self.data_dir = os.path.join(workdir, "data")
+        self.records = records
+        self.shape = shape
+        self.kadi_url = kadi_url
+        self.s3 = s3
+        self.prefixes: list[str] = []
+        with open(os.path.join(workdir, "qualitycheck_config.toml"), "w",
+                  encoding="utf-8") as config:
+            config.write(f's3_endpoint = "{s3.url}"\n'
+                         f's3_bucket = "{s3.bucket}"\n'
+                         f'gitlab_api_url = "{gitlab_url}/api/v4"\n'
+                         'gitlab_poll_min_delay = 0.05\n'
+                         'gitlab_poll_max_delay = 0.2\n'
+                         'gitlab_max_requests_per_second = 100\n')
+        for varname in ("S3_ACCESS_KEY_ID", "S3_SECRET_ACCESS_KEY", "GITLAB_PIPELINE_TOKEN",
+                        "GITLAB_API_TOKEN"):
+            os.environ.setdefault(varname, "benchmark")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    def _eln(self, rid: int) -> str:
+        return os.path.join(self.data_dir, "ruqad", str(rid), "export.eln")
+
+    def _checker(self):
+        from ruqad.qualitycheck import QualityChecker
+        with _working_dir(self.workdir):
+            return QualityChecker()
+
+    def kadi_collect(self) -> dict:
+        from kadi_apy import KadiManager
+        from ruqad.kadi import collect_records_created_after
+        oldest = min(created_at for _, created_at in self.records)
+        with KadiManager(host=self.kadi_url, pat="benchmark") as manager:
+            found = collect_records_created_after(manager, oldest - timedelta(seconds=1))
+        assert len(found) == len(self.records), (len(found), len(self.records))
+        return {}
+
+    def kadi_download(self) -> dict:
+        from kadi_apy import KadiManager
+        from ruqad.kadi import download_elns_for
+        with TemporaryDirectory() as target_dir, \
+                KadiManager(host=self.kadi_url, pat="benchmark") as manager:
+            errors = download_elns_for(
+                manager, {rid: os.path.join(target_dir, f"{rid}.eln") for rid, _ in self.records})
+        assert not errors, errors
+        return {"bytes": sum(os.path.getsize(self._eln(rid)) for rid, _ in self.records)}
+
+    def qc_upload(self) -> dict:
+        qc = self._checker()
+        self.prefixes = []
+        for rid, _ in self.records:
+            prefix = f"data/{rid}/benchmark/"
+            qc._upload(self._eln(rid), prefix=prefix)
+            self.prefixes.append(prefix)
+        size = sum(size for _, size, _ in qc.upload_stats)
+        return {"bytes": size}
+
+    def qc_cleanup(self) -> dict:
+        if not self.prefixes:
+            self.qc_upload()
+        qc = self._checker()
+        for prefix in self.prefixes:
+            qc._cleanup(prefix=prefix)
+        self.prefixes = []
+        return {}
+
+    def qc_check(self) -> dict:
+        qc = self._checker()
+        with TemporaryDirectory() as target_dir:
+            for rid, _ in self.records:
+                assert qc.check(self._eln(rid), target_dir=target_dir, record_id=rid)
+        return {}
+
+    def scan_validate(self) -> dict:
+        from caoscrawler.validator import load_json_schema_from_datamodel_yaml, validate
+        from ruqad import crawler
+        schemas = load_json_schema_from_datamodel_yaml(
+            str(crawler.ruqad_crawler_settings.joinpath("datamodel.yaml")))
+        entities = crawler._scan(self.data_dir)
+        validation = validate([ent for ent in entities if ent.role == "Record"], schemas)
+        return {"entities": len(entities), "valid": all(valid for valid, _ in validation)}
+
+    def trigger_crawler(self) -> dict:
+        from ruqad.crawler import trigger_crawler
+        valid, ent_qc = trigger_crawler(self.data_dir, single_scan=True)
+        return {"valid": valid, "quality_checks": len(ent_qc)}
+
+
+def run(n_records: int, shape: Shape, repeat: int, stages: list[str]) -> dict:
+    """Create the synthetic records, start the stand-ins and run the stages."""
+    results: dict = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "n_records": n_records,
+        "repeat": repeat,
+        "shape": shape.as_dict(),
+        "stages": {},
+    }
+    with TemporaryDirectory() as workdir, ExitStack() as stack:
+        records = make_records(os.path.join(workdir, "data"), n_records, shape)
+        exports = {rid: os.path.join(workdir, "data", "ruqad", str(rid), "export.eln")
+                   for rid, _ in records}
+        artifacts = make_report(os.path.join(workdir, "artifacts.zip"), shape)
+        kadi = stack.enter_context(StubServer(kadi_handler(records, exports)))
+        gitlab = stack.enter_context(StubServer(gitlab_handler(artifacts)))
+        s3 = stack.enter_context(S3Server("ruqad-benchmark"))
+        benchmarks = Benchmarks(workdir, records, shape, kadi.url, gitlab.url, s3)
+        for stage in stages:
+            print(f"Running {stage} ...", file=sys.stderr)
+            try:
+                results["stages"][stage] = _timed(getattr(benchmarks, stage), repeat, n_records)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                traceback.print_exc()
+                results["stages"][stage] = {"error": f"{type(exc).__name__}: {exc}"}
+    return results
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10, help="Number of records.")
+    parser.add_argument("--files", type=int, default=2, help="Data files per record.")
+    parser.add_argument("--file-size", type=int, default=256 * 1024,
+                        help="Size of each data file in bytes.")
+    parser.add_argument("--authors", type=int, default=1, help="Authors per record.")
+    parser.add_argument("--variables", type=int, default=3,
+                        help="Measured variables per record.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES),
+                        help="The stages to run, by default all.")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file.")
+    return parser.parse_args()
+
+
+def main():
+    args = _parse_arguments()
+    shape = Shape(n_files=args.files, file_size=args.file_size, n_authors=args.authors,
+                  n_variables=args.variables)
+    results = run(args.records, shape, args.repeat, args.stages)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fileobj:
+            fileobj.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
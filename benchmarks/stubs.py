@@ -0,0 +1,174 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Local stand-ins for Kadi, GitLab and S3.
+
+Kadi and GitLab are small HTTP servers which answer the requests that RuQaD makes.  S3 is provided
+by the moto server (``pip install "moto[server]"``).
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import re
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    """Run a request handler class in a background thread, as a context manager."""
+
+    def __init__(self, handler: type[BaseHTTPRequestHandler]):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def __enter__(self) -> StubServer:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str = "application/json", status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data, status: int = 200):
+        self._send(json.dumps(data).encode(), status=status)
+
+
+def kadi_handler(records: list[tuple[int, datetime]], exports: dict[int, str]
+                 ) -> type[BaseHTTPRequestHandler]:
+    """Return a handler for the Kadi record search and the RO-Crate export.
+
+Parameters
+----------
+records : list[tuple[int, datetime]]
+  IDs and creation dates of the records, newest first.
+
+exports : dict[int, str]
+  The .eln file which is returned as export of each record.
+    """
+
+    class KadiHandler(_JSONHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path in ("/api/records", "/api/v1/records"):
+                per_page = int(query.get("per_page", ["10"])[0])
+                page = int(query.get("page", ["1"])[0])
+                items = records[(page - 1) * per_page:page * per_page]
+                self._send_json({
+                    "items": [{"id": rid, "created_at": created_at.isoformat()}
+                              for rid, created_at in items],
+                    "_pagination": {"page": page, "per_page": per_page,
+                                    "total_items": len(records),
+                                    "total_pages": max(math.ceil(len(records) / per_page), 1)},
+                })
+                return
+            match = re.fullmatch(r"/api(?:/v1)?/records/([0-9]+)/export/ro-crate", url.path)
+            if match and int(match.group(1)) in exports:
+                with open(exports[int(match.group(1))], "rb") as fileobj:
+                    self._send(fileobj.read(), content_type="application/zip")
+                return
+            self._send_json({"code": 404}, status=404)
+
+    return KadiHandler
+
+
+def gitlab_handler(artifacts: str, running_polls: int = 1) -> type[BaseHTTPRequestHandler]:
+    """Return a handler for the GitLab pipeline API.
+
+Every triggered pipeline reports "running" for ``running_polls`` polls and then "success".  The
+report job returns the archive ``artifacts``.
+    """
+    lock = threading.Lock()
+    polls: dict[str, int] = {}
+
+    class GitlabHandler(_JSONHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.endswith("/trigger/pipeline"):
+                with lock:
+                    pipeline_id = str(len(polls) + 1)
+                    polls[pipeline_id] = 0
+                self._send_json({"id": int(pipeline_id), "status": "created"}, status=201)
+                return
+            self._send_json({"error": "404 Not Found"}, status=404)
+
+        def do_GET(self):
+            match = re.search(r"/pipelines/([0-9]+)(/jobs)?$", self.path)
+            if match and match.group(2):
+                self._send_json([{"name": "evaluate", "status": "success", "id": 1},
+                                 {"name": "report", "status": "success", "id": 2}])
+            elif match:
+                with lock:
+                    polls[match.group(1)] += 1
+                    running = polls[match.group(1)] <= running_polls
+                self._send_json({"id": int(match.group(1)),
+                                 "status": "running" if running else "success",
+                                 "finished_at": None if running else "2024-11-01T12:00:00Z"})
+            elif self.path.endswith("/artifacts"):
+                with open(artifacts, "rb") as fileobj:
+                    self._send(fileobj.read(), content_type="application/zip")
+            else:
+                self._send_json({"error": "404 Not Found"}, status=404)
+
+    return GitlabHandler
+
+
+class S3Server:
+    """A moto S3 server with one bucket, as a context manager."""
+
+    def __init__(self, bucket: str):
+        from moto.server import ThreadedMotoServer  # only needed for the benchmarks
+        self.bucket = bucket
+        self._server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.get_host_and_port()
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> S3Server:
+        import boto3
+        self._server.start()
+        boto3.client("s3", endpoint_url=self.url, aws_access_key_id="benchmark",
+                     aws_secret_access_key="benchmark",
+                     region_name="us-east-1").create_bucket(Bucket=self.bucket)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.stop()
@@ -0,0 +1,174 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Generator for synthetic Kadi .eln exports and quality check reports.
+
+The exports have the same structure as the samples in ``end-to-end-tests/data/crawler_data``, with
+a configurable number and size of data files, authors and measured variables.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from zipfile import ZIP_DEFLATED, ZipFile
+
+KADI_URL = "https://kadi.example.com"
+
+
+class Shape:
+    """The size of the synthetic records."""
+
+    def __init__(self, n_files: int = 2, file_size: int = 256 * 1024, n_authors: int = 1,
+                 n_variables: int = 3):
+        """
+Parameters
+----------
+n_files : int, default=2
+  Number of data files per record.
+
+file_size : int, default=256 KiB
+  Size of each data file in bytes.
+
+n_authors : int, default=1
+  Number of authors per record, at least one.
+
+n_variables : int, default=3
+  Number of measured variables per record.  The first ones are ``notes``, ``rating`` and
+  ``voltage``, which are known to the data model, the others are generic.
+        """
+        if n_authors < 1:
+            raise ValueError("A record needs at least one author.")
+        self.n_files = n_files
+        self.file_size = file_size
+        self.n_authors = n_authors
+        self.n_variables = n_variables
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def _csv_data(size: int, rng: random.Random) -> bytes:
+    """CSV data of about ``size`` bytes which compresses like measured values."""
+    lines = ["time,value"]
+    length = len(lines[0]) + 1
+    index = 0
+    while length < size:
+        line = f"{index},{rng.uniform(-1000, 1000):.6f}"
+        lines.append(line)
+        length += len(line) + 1
+        index += 1
+    return ("\n".join(lines) + "\n").encode()[:size]
+
+
+def _variables(n_variables: int, rng: random.Random) -> list[dict]:
+    known = [
+        {"@type": "PropertyValue", "additionalType": "str", "propertyID": "notes",
+         "value": "Synthetic benchmark record."},
+        {"@type": "PropertyValue", "additionalType": "int", "propertyID": "rating",
+         "value": rng.randint(1, 5)},
+        {"@type": "PropertyValue", "additionalType": "float", "propertyID": "voltage",
+         "unitText": "V", "value": rng.uniform(0, 10000)},
+    ]
+    generic = [{"@type": "PropertyValue", "additionalType": "float", "propertyID": f"var{ii}",
+                "value": rng.uniform(0, 1)} for ii in range(max(n_variables - len(known), 0))]
+    return (known + generic)[:n_variables]
+
+
+def make_eln(path: str, rid: int, shape: Shape, created_at: datetime, seed: int = 0) -> str:
+    """Write a synthetic .eln export of the record ``rid`` to ``path``."""
+    rng = random.Random(seed + rid)
+    name = f"record-{rid}"
+    authors = [{"@id": f"{KADI_URL}/users/{ii + 1}", "@type": "Person", "name": f"user{ii + 1}"}
+               for ii in range(shape.n_authors)]
+    author_refs = [{"@id": author["@id"]} for author in authors]
+    files = [f"./{name}/files/data{ii}.csv" for ii in range(shape.n_files)]
+    dataset = {
+        "@id": f"./{name}/",
+        "@type": "Dataset",
+        "author": author_refs[0] if len(author_refs) == 1 else author_refs,
+        "dateCreated": created_at.isoformat(),
+        "dateModified": created_at.isoformat(),
+        "description": {"@type": "TextObject", "encodingFormat": "text/markdown",
+                        "text": f"Synthetic record {rid}."},
+        "hasPart": [{"@id": f} for f in files],
+        "identifier": name,
+        "license": {"@id": "https://creativecommons.org/publicdomain/zero/1.0/"},
+        "name": name,
+        "variableMeasured": _variables(shape.n_variables, rng),
+    }
+    graph = [
+        {"@id": "ro-crate-metadata.json", "@type": "CreativeWork", "about": {"@id": "./"},
+         "conformsTo": {"@id": "https://w3id.org/ro/crate/1.1"},
+         "dateCreated": created_at.isoformat(), "sdPublisher": {"@id": KADI_URL},
+         "version": "1.0"},
+        {"@id": "./", "@type": ["Dataset"], "hasPart": [{"@id": f"./{name}/"}]},
+        {"@id": KADI_URL, "@type": "Organization", "name": "Kadi4Mat", "url": KADI_URL},
+        {"@id": "https://creativecommons.org/publicdomain/zero/1.0/", "@type": "CreativeWork",
+         "identifier": "CC0-1.0", "name": "CC0 1.0",
+         "url": "https://creativecommons.org/publicdomain/zero/1.0/"},
+        dataset,
+    ] + authors + [
+        {"@id": f, "@type": "File", "contentSize": str(shape.file_size),
+         "encodingFormat": "text/csv", "name": os.path.basename(f)} for f in files
+    ]
+    with ZipFile(path, "w", compression=ZIP_DEFLATED) as zipf:
+        zipf.writestr(f"{name}/ro-crate-metadata.json",
+                      json.dumps({"@context": "https://w3id.org/ro/crate/1.1/context",
+                                  "@graph": graph}, indent=2))
+        for filename in files:
+            zipf.writestr(f"{name}/{filename[2:]}", _csv_data(shape.file_size, rng))
+    return path
+
+
+def make_report(path: str, shape: Shape, seed: int = 0) -> str:
+    """Write a synthetic quality check report archive with a ``qc_summary.json`` to ``path``."""
+    rng = random.Random(seed)
+    num_total = 10 * shape.n_files
+    summary = {"check_counts": {"num_total_checks": num_total,
+                                "num_passing_checks": rng.randint(0, num_total)}}
+    with ZipFile(path, "w", compression=ZIP_DEFLATED) as zipf:
+        zipf.writestr("qc_summary.json", json.dumps(summary))
+        for ii in range(shape.n_files):
+            zipf.writestr(f"report/data{ii}.html",
+                          b"<pre>\n" + _csv_data(shape.file_size, rng) + b"</pre>\n")
+    return path
+
+
+def make_records(target_dir: str, n_records: int, shape: Shape, with_reports: bool = True,
+                 start: int = 1000, seed: int = 0) -> list[tuple[int, datetime]]:
+    """Create ``<target_dir>/ruqad/<rid>/export.eln`` (and ``report.zip``) for several records.
+
+Returns
+-------
+out : list[tuple[int, datetime]]
+  IDs and creation dates of the records, newest first like the Kadi search.
+    """
+    now = datetime.now(timezone.utc)
+    records = []
+    for ii in range(n_records):
+        rid = start + ii
+        created_at = now - timedelta(minutes=n_records - ii)
+        record_dir = os.path.join(target_dir, "ruqad", str(rid))
+        os.makedirs(record_dir, exist_ok=True)
+        make_eln(os.path.join(record_dir, "export.eln"), rid, shape, created_at, seed=seed)
+        if with_reports:
+            make_report(os.path.join(record_dir, "report.zip"), shape, seed=seed + rid)
+        records.append((rid, created_at))
+    return records[::-1]
@@ -22,3 +22,35 @@ KADITOKEN=pat_KADI123456789
 #GITLAB_API_TOKEN=glpat-987654321
 
 SKIP_QUALITY_CHECK=True
+
+## Monitor
+# Optional: SQLite file where the monitor stores its progress, to resume after a restart.
+#MONITOR_STATE_FILE=/var/lib/ruqad/monitor.sqlite
+# Optional: How often a failed record is processed before it is given up.
+#MONITOR_MAX_ATTEMPTS=3
+# Optional: Number of records which are processed concurrently, and the maximum number of
+# concurrent Kadi downloads, quality checks and crawler runs.
+#MONITOR_WORKERS=1
+#MAX_CONCURRENT_DOWNLOADS=4
+#MAX_CONCURRENT_CHECKS=1
+#MAX_CONCURRENT_CRAWLS=1
+# Optional: Many new records are processed in batches of this size, with a pause (in seconds)
+# between the batches.
+#MONITOR_BATCH_SIZE=25
+#MONITOR_BATCH_PAUSE=10
+# Optional: Serve metrics in the Prometheus text format at http://<host>:<port>/metrics.
+#MONITOR_METRICS_PORT=9100
+# Optional: Append a trace of each record to this file, in the Chrome trace event format
+# ("chrome", for chrome://tracing or Perfetto) or as OTLP JSON lines ("otlp").
+#MONITOR_TRACE_FILE=/tmp/ruqad_traces.json
+#MONITOR_TRACE_FORMAT=chrome
+# Optional: Receive notifications about created or updated records at
+# http://<host>:<port>/events and process them right away, e.g. from a Kadi webhook:
+#   POST {"event": "record.created", "record_id": 42}, header X-Ruqad-Token: <token>
+# The receiver only listens on the local host, unless MONITOR_WEBHOOK_ADDR is set ("" for all
+# addresses).  Other addresses require MONITOR_WEBHOOK_TOKEN.
+#MONITOR_WEBHOOK_PORT=9101
+#MONITOR_WEBHOOK_ADDR=127.0.0.1
+#MONITOR_WEBHOOK_TOKEN=
+# Optional: Seconds between the searches for new records.  Default: 60, or 900 with notifications.
+#MONITOR_POLL_INTERVAL=60
@@ -0,0 +1,146 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Safe inspection of zip archives (.eln exports and quality reports).
+
+The limits are checked against the central directory only, so oversized or malicious archives are
+rejected before any member is decompressed.
+"""
+
+from __future__ import annotations
+
+import stat
+from pathlib import PurePosixPath
+from typing import IO, Optional
+from zipfile import ZipFile, ZipInfo
+
+
+class UnsafeArchive(ValueError):
+    """The archive exceeds the limits or contains unsafe member names."""
+
+
+class ArchiveLimits:
+    """Limits for the archives which are accepted."""
+
+    def __init__(self, max_total_size: int = 20 * 1024**3, max_ratio: float = 100,
+                 max_members: int = 10000, ratio_min_size: int = 1024**2):
+        """
+Parameters
+----------
+max_total_size : int, default=20 GiB
+  The maximum sum of the uncompressed member sizes in bytes.
+
+max_ratio : float, default=100
+  The maximum compression ratio (uncompressed / compressed size) of a member.
+
+max_members : int, default=10000
+  The maximum number of members.
+
+ratio_min_size : int, default=1 MiB
+  The compression ratio is only checked for members which are larger than this, because small
+  text files can legitimately be compressed very well.
+        """
+        self.max_total_size = max_total_size
+        self.max_ratio = max_ratio
+        self.max_members = max_members
+        self.ratio_min_size = ratio_min_size
+
+    @classmethod
+    def from_config(cls, config: dict) -> ArchiveLimits:
+        """Create limits from the ``archive_*`` keys of a config, with defaults for the rest."""
+        kwargs = {}
+        for key in ("max_total_size", "max_ratio", "max_members", "ratio_min_size"):
+            if f"archive_{key}" in config:
+                kwargs[key] = config[f"archive_{key}"]
+        return cls(**kwargs)
+
+
+def check_members(infolist: list[ZipInfo], limits: Optional[ArchiveLimits] = None):
+    """Raise UnsafeArchive if the members exceed the limits or have unsafe names.
+
+Parameters
+----------
+infolist : list[ZipInfo]
+  The members, as read from the central directory.
+
+limits : Optional[ArchiveLimits]
+  The limits to check.  By default, the default limits are used.
+    """
+    if limits is None:
+        limits = ArchiveLimits()
+    if len(infolist) > limits.max_members:
+        raise UnsafeArchive(f"Too many members: {len(infolist)} > {limits.max_members}")
+    total_size = 0
+    for info in infolist:
+        path = PurePosixPath(info.filename.replace("\\", "/"))
+        if not path.parts or path.is_absolute() or ".." in path.parts or ":" in path.parts[0]:
+            raise UnsafeArchive(f"Unsafe member name: {info.filename}")
+        if stat.S_ISLNK(info.external_attr >> 16):
+            raise UnsafeArchive(f"Symbolic link in archive: {info.filename}")
+        if (info.file_size > limits.ratio_min_size
+                and info.file_size > limits.max_ratio * max(info.compress_size, 1)):
+            raise UnsafeArchive(f"Compression ratio of {info.filename} exceeds {limits.max_ratio}")
+        total_size += info.file_size
+        if total_size > limits.max_total_size:
+            raise UnsafeArchive(f"Uncompressed size exceeds {limits.max_total_size} bytes")
+
+
+def check_archive(filename: str, limits: Optional[ArchiveLimits] = None):
+    """Raise UnsafeArchive if the zip archive ``filename`` exceeds the limits."""
+    with SafeArchive(filename, limits):
+        pass
+
+
+class SafeArchive:
+    """A zip archive whose central directory has been checked against limits.
+
+The members can be read one at a time with ``open``, without extracting the archive.  The readers
+of ``zipfile`` stop at the uncompressed size from the central directory, so a member cannot
+decompress to more than its checked size.
+    """
+
+    def __init__(self, filename: str, limits: Optional[ArchiveLimits] = None):
+        """
+Parameters
+----------
+filename : str
+  The zip archive.
+
+limits : Optional[ArchiveLimits]
+  The limits to check.  By default, the default limits are used.
+        """
+        self._zipf = ZipFile(filename)
+        try:
+            self.members = self._zipf.infolist()
+            check_members(self.members, limits)
+        except BaseException:
+            self._zipf.close()
+            raise
+
+    def open(self, info: ZipInfo) -> IO[bytes]:
+        """Open a member for reading."""
+        return self._zipf.open(info)
+
+    def close(self):
+        """Close the archive."""
+        self._zipf.close()
+
+    def __enter__(self) -> SafeArchive:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
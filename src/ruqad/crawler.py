@@ -3,22 +3,313 @@
 # A. Schlemmer, 11/2024
 
 
+import io
+import math
 import os
+import pickle
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from functools import partial
+from hashlib import sha512
 from importlib import resources
 from os import walk
 from os.path import join
+from types import FunctionType
+from typing import Any, Callable, Optional
 
 import linkahead as db
-from caoscrawler.crawl import crawler_main
-from caoscrawler.scanner import scan_directory
+import yaml
+from linkahead.utils.escape import escape_squoted_text
+from caoscrawler.crawl import (Crawler, SecurityMode, _check_record_types,
+                               _fix_file_paths, crawler_main)
+from caoscrawler.identifiable_adapters import CaosDBIdentifiableAdapter
+from caoscrawler.scanner import (create_converter_registry,
+                                 create_transformer_registry, load_definition,
+                                 scan_structure_elements)
+from caoscrawler.structure_elements import Directory
 from caoscrawler.validator import (load_json_schema_from_datamodel_yaml,
                                    validate)
 
+from ruqad import metrics, tracing
+from ruqad.archive import ArchiveLimits, check_archive
+
 ruqad_crawler_settings = resources.files('ruqad').joinpath('resources/crawler-settings')
 
+# Parsed crawler settings, by file name: ((mtime, size), parsed content)
+_settings_cache: dict[str, tuple[tuple[int, int], Any]] = {}
+
+
+def _cached(filename, loader: Callable[[str], Any]) -> Any:
+    """
+    Return ``loader(filename)``, cached for the lifetime of the process.
+
+    The cached value is discarded when the modification time or the size of the file changes.
+    """
+    filename = os.fspath(filename)
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _settings_cache.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, loader(filename))
+        _settings_cache[filename] = cached
+    return cached[1]
+
+
+def _load_cfood(filename: str) -> tuple[dict, dict, dict]:
+    """Load the crawler definition and create its converter and transformer registries."""
+    crawler_definition = load_definition(filename)
+    return (crawler_definition,
+            create_converter_registry(crawler_definition),
+            create_transformer_registry(crawler_definition))
+
 
-def trigger_crawler(target_dir: str) -> tuple[bool, list[db.Entity]]:
+def _load_identifiables(filename: str) -> dict:
+    """Load the identifiable definitions, as expected by ``load_from_yaml_object``."""
+    with open(filename, "r", encoding="utf-8") as yaml_f:
+        return yaml.safe_load(yaml_f)
+
+
+def _scan(target_dir: str, restricted_path: Optional[list[str]] = None) -> list[db.Entity]:
+    """
+    Scan ``target_dir`` with the RuQaD cfood.
+
+    This is equivalent to ``scan_directory``, but uses the cached crawler definition.
+    """
+    crawler_definition, converter_registry, transformer_registry = _cached(
+        ruqad_crawler_settings.joinpath('cfood.yaml'), _load_cfood)
+    return scan_structure_elements(
+        Directory(os.path.basename(os.path.normpath(target_dir)), target_dir),
+        crawler_definition,
+        converter_registry,
+        restricted_path=restricted_path,
+        registered_transformer_functions=transformer_registry)
+
+
+def _rebuild_list(cls: type, state: dict, items: list) -> list:
+    """Counterpart to ``_EntityPickler`` for list subclasses such as ``PropertyList``."""
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    list.extend(obj, items)
+    return obj
+
+
+class _EntityPickler(pickle.Pickler):
+    """
+    Pickler for crawled entities, to send them from worker processes to the main process.
+
+    LinkAhead entities cannot be pickled as they are: They store ``lambda`` functions as
+    ``is_valid`` and ``is_deleted``, and their property and parent lists need their attributes to
+    be set before the items are added.
+    """
+
+    def reducer_override(self, obj):
+        if isinstance(obj, FunctionType):
+            if obj.__name__ == "<lambda>" and obj.__module__.startswith("linkahead"):
+                # These lambdas only return a constant boolean.
+                return partial, (bool, obj())
+        elif (isinstance(obj, list) and type(obj) is not list
+              and type(obj).__module__.startswith("linkahead")):
+            return _rebuild_list, (type(obj), obj.__dict__, list(obj))
+        return NotImplemented
+
+
+def _scan_record_dirs(target_dir: str, record_ids: list[str]) -> bytes:
+    """
+    Scan the given record directories in ``<target_dir>/ruqad/``.
+
+    This is run in the worker processes of ``_scan_parallel``.
+
+    Returns
+    -------
+
+    out: bytes
+      The scanned entities, pickled with ``_EntityPickler``.
+    """
+    dir_name = os.path.basename(os.path.normpath(target_dir))
+    entities = []
+    for rid in record_ids:
+        entities.extend(_scan(target_dir, restricted_path=[dir_name, "ruqad", rid]))
+    buffer = io.BytesIO()
+    _EntityPickler(buffer).dump(entities)
+    return buffer.getvalue()
+
+
+def _scan_parallel(target_dir: str, max_workers: int) -> list[db.Entity]:
+    """
+    Scan ``target_dir`` with a pool of worker processes.
+
+    The record directories ``<target_dir>/ruqad/<record_id>`` are independent of each other, so
+    they are distributed over the workers in chunks.  The result is the same as from ``_scan``,
+    also the order of the entities.
+
+    Parameters
+    ----------
+
+    target_dir: str
+      The directory to be scanned.
+
+    max_workers: int
+      The number of worker processes.
+    """
+    ruqad_dir = join(target_dir, "ruqad")
+    if not os.path.isdir(ruqad_dir):
+        return _scan(target_dir)
+    # The scanner visits the directories in sorted order.
+    record_ids = sorted(name for name in os.listdir(ruqad_dir)
+                        if os.path.isdir(join(ruqad_dir, name)))
+    # Several chunks per worker, so that a few large records do not keep a single worker busy.
+    chunk_size = max(1, math.ceil(len(record_ids) / (4 * max_workers)))
+    chunks = [record_ids[ii:ii + chunk_size] for ii in range(0, len(record_ids), chunk_size)]
+
+    entities = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for result in executor.map(partial(_scan_record_dirs, target_dir), chunks):
+            entities.extend(pickle.loads(result))
+    return entities
+
+
+def _file_unchanged(filename: str, remote: db.File) -> bool:
+    """
+    Check whether the local file has the same content as the file stored on the server.
+
+    The size is compared first, the SHA-512 checksum (which the server stores for each file) is
+    only computed if the sizes match.  The file is read in chunks, so that large archives are not
+    loaded into memory.
+
+    Returns
+    -------
+
+    out: bool
+      True if the local file is known to be identical to the remote one.
+    """
+    if remote.checksum is None:
+        return False
+    if remote.size is not None and remote.size != os.path.getsize(filename):
+        return False
+    checksum = sha512()
+    with open(filename, "rb") as fileobj:
+        for chunk in iter(lambda: fileobj.read(2**16), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest().lower() == remote.checksum.lower()
+
+
+def _archive_files(target_dir: str) -> list[tuple[str, str]]:
+    """Return the directory and the name of all .eln and .zip files below ``target_dir``."""
+    return [(fp, fn) for fp, ds, fs in walk(target_dir) for fn in fs
+            if fn.endswith(".eln") or fn.endswith(".zip")]
+
+
+def _check_archives(target_dir: str, limits: Optional[ArchiveLimits] = None):
+    """
+    Raise UnsafeArchive if an .eln or .zip file below ``target_dir`` exceeds the limits.
+
+    Only the central directories are read, so this is cheap compared to the extraction by the
+    crawler's converters, which it must precede.
+    """
+    for fp, fn in _archive_files(target_dir):
+        check_archive(join(fp, fn), limits)
+
+
+def _register_files(target_dir: str, skip_unchanged: bool = False) -> int:
+    """
+    Insert or update all .eln and .zip files below ``target_dir``.
+
+    Instead of one retrieve and one insert/update per file, the files are handled in bulk: One
+    query for the existing files in each directory, one insert of all new files and one update of
+    all existing files.
+
+    Parameters
+    ----------
+
+    target_dir: str
+      The directory to be searched for files.
+
+    skip_unchanged: bool, default=False
+      If True, existing files whose content is identical to the file on the server are not
+      uploaded again.
+
+    Returns
+    -------
+
+    out: int
+      The number of requests saved compared to handling each file separately.
+    """
+    files = db.Container()
+    for fp, fn in _archive_files(target_dir):
+        files.append(db.File(file=join(fp, fn), path=join(fp[len(target_dir):], fn)))
+    if len(files) == 0:
+        return 0
+
+    # One query per directory (usually one per record), so that only the files next to the
+    # registered ones are retrieved, not everything below a common parent such as /ruqad.
+    paths = {f.path for f in files}
+    directories = sorted({os.path.dirname(path) for path in paths})
+    existing = {}
+    for directory in directories:
+        query = "FIND FILE WHICH IS STORED AT '{}/*'".format(
+            escape_squoted_text(directory.rstrip("/")))
+        existing.update({f.path: f for f in db.execute_query(query) if f.path in paths})
+
+    inserts = db.Container()
+    updates = db.Container()
+    for file_ent in files:
+        remote = existing.get(file_ent.path)
+        if remote is None:
+            print(f"insert {file_ent.file}")
+            inserts.append(file_ent)
+        elif skip_unchanged and _file_unchanged(file_ent.file, remote):
+            print(f"unchanged {file_ent.file}")
+        else:
+            print(f"update {file_ent.file}")
+            remote.file = file_ent.file
+            updates.append(remote)
+    if len(inserts) > 0:
+        inserts.insert()
+    if len(updates) > 0:
+        updates.update()
+
+    n_requests = len(directories) + int(len(inserts) > 0) + int(len(updates) > 0)
+    saved = 2 * len(files) - n_requests
+    print(f"Registered {len(files)} files with {n_requests} requests ({saved} requests saved).")
+    return saved
+
+
+def _synchronize(entities: list[db.Entity], target_dir: str):
+    """
+    Synchronize already scanned entities with the LinkAhead server.
+
+    This does the same as ``crawler_main`` after its scanning step, so the crawled directory does
+    not have to be scanned a second time.
+
+    Parameters
+    ----------
+
+    entities: list[db.Entity]
+      The result of ``scan_directory`` for ``target_dir``.  The list is modified in place.
+
+    target_dir: str
+      The directory which was scanned.
+    """
+    _fix_file_paths(entities, add_prefix=None,
+                    remove_prefix="/" + os.path.basename(target_dir))
+    _check_record_types(entities)
+
+    ident = CaosDBIdentifiableAdapter()
+    ident.load_from_yaml_object(_cached(ruqad_crawler_settings.joinpath('identifiables.yaml'),
+                                        _load_identifiables))
+    crawler = Crawler(securityMode=SecurityMode.UPDATE, identifiableAdapter=ident)
+    crawler.synchronize(commit_changes=True,
+                        unique_names=True,
+                        crawled_data=entities,
+                        path_for_authorized_run=target_dir)
+
+
+def trigger_crawler(target_dir: str, single_scan: bool = False,
+                    skip_unchanged: bool = False,
+                    scan_workers: Optional[int] = None,
+                    archive_limits: Optional[ArchiveLimits] = None
+                    ) -> tuple[bool, list[db.Entity]]:
     """
     Trigger a standard crawler run equivalent to the command line:
 
@@ -26,6 +317,28 @@ def trigger_crawler(target_dir: str) -> tuple[bool, list[db.Entity]]:
     caosdb-crawler -i crawler/identifiables.yaml -s update crawler/cfood.yaml <target_dir>
     ```
 
+    Parameters
+    ----------
+
+    target_dir: str
+      The directory to be crawled.
+
+    single_scan: bool, default=False
+      If True, the entities from the scan for the metadata validation are synchronized directly,
+      instead of scanning ``target_dir`` again with ``crawler_main``.  Each archive is then only
+      unpacked and matched against the cfood once.
+
+    skip_unchanged: bool, default=False
+      If True, .eln and .zip files which are already stored on the server with identical content
+      are not uploaded again.
+
+    scan_workers: Optional[int], default=None
+      If given, the record directories are scanned in parallel by this many worker processes.
+
+    archive_limits: Optional[ArchiveLimits], default=None
+      The .eln and .zip files are checked against these limits (by default the default limits)
+      before they are uploaded or unpacked.  If one exceeds them, ``UnsafeArchive`` is raised.
+
     Returns
     -------
 
@@ -35,29 +348,18 @@ def trigger_crawler(target_dir: str) -> tuple[bool, list[db.Entity]]:
       - 2nd element of tuple: list of quality check records.
     """
 
-    # insert all .zip and .eln files, if they do not yet exist
-    for fp, ds, fs in walk(target_dir):
-        for fn in fs:
-            if fn.endswith(".eln") or fn.endswith(".zip"):
-
-                file_path = join(target_dir, fp, fn)
-                file_entity = join(fp[len(target_dir):], fn)
-                file_ent = db.File(file=file_path,
-                                   path=file_entity)
-
-                print(f"retrieve {join(fp, fn)}")
-                file_ent.retrieve()
-                if file_ent.id is None:
-                    print(f"insert {join(fp, fn)}")
-                    file_ent.insert()
-                else:
-                    print(f"update {join(fp, fn)}")
-                    file_ent.update()
+    with tracing.span("archive_check"):
+        _check_archives(target_dir, archive_limits)
+    with metrics.stage("file_registration"):
+        _register_files(target_dir, skip_unchanged=skip_unchanged)
     print("meta data check")
-    datamodel_yaml_file = ruqad_crawler_settings.joinpath('datamodel.yaml')
-    schemas = load_json_schema_from_datamodel_yaml(datamodel_yaml_file)
-    entities = scan_directory(target_dir,
-                              ruqad_crawler_settings.joinpath('cfood.yaml'))
+    schemas = _cached(ruqad_crawler_settings.joinpath('datamodel.yaml'),
+                      load_json_schema_from_datamodel_yaml)
+    with metrics.stage("crawler_scan"):
+        if scan_workers is None:
+            entities = _scan(target_dir)
+        else:
+            entities = _scan_parallel(target_dir, max_workers=scan_workers)
 
     ent_qc = []                 # Quality check result records
 
@@ -72,7 +374,8 @@ def trigger_crawler(target_dir: str) -> tuple[bool, list[db.Entity]]:
 
     # Remove files from entities:
     records = [r for r in entities if r.role == "Record"]
-    validation = validate(records, schemas)
+    with metrics.stage("validation"):
+        validation = validate(records, schemas)
 
     if not all([i[0] for i in validation]):
         print("Metadata validation failed. Validation errors:")
@@ -82,11 +385,19 @@ def trigger_crawler(target_dir: str) -> tuple[bool, list[db.Entity]]:
         return (False, ent_qc)
 
     print("crawl", target_dir)
-    crawler_main(crawled_directory_path=target_dir,
-                 debug=True,
-                 cfood_file_name=ruqad_crawler_settings.joinpath('cfood.yaml'),
-                 identifiables_definition_file=ruqad_crawler_settings.joinpath(
-                     'identifiables.yaml'),
-                 remove_prefix="/" + os.path.basename(target_dir))
+    if single_scan:
+        # Synchronize a copy, so that the returned quality check records are not changed by the
+        # path fixing and the synchronization.
+        with metrics.stage("linkahead_sync"):
+            _synchronize(deepcopy(entities), target_dir)
+        return (True, ent_qc)
+
+    with metrics.stage("linkahead_sync"):
+        crawler_main(crawled_directory_path=target_dir,
+                     debug=True,
+                     cfood_file_name=ruqad_crawler_settings.joinpath('cfood.yaml'),
+                     identifiables_definition_file=ruqad_crawler_settings.joinpath(
+                         'identifiables.yaml'),
+                     remove_prefix="/" + os.path.basename(target_dir))
 
     return (True, ent_qc)
@@ -18,7 +18,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Any
+from functools import lru_cache
+from importlib import resources
+from typing import Any, Callable
+
+import yaml
+
+DEFAULT_DATAMODEL = str(resources.files('ruqad').joinpath(
+    'resources/crawler-settings/datamodel.yaml'))
+
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        if value.lower() in ("true", "1", "yes"):
+            return True
+        if value.lower() in ("false", "0", "no", ""):
+            return False
+        raise ValueError(f"Cannot cast {value!r} to bool.")
+    return bool(value)
+
+
+# Cast functions for the scalar LinkAhead datatypes.
+DATATYPE_CASTS: dict[str, Callable[[Any], Any]] = {
+    "DOUBLE": float, "INTEGER": int, "BOOLEAN": _to_bool, "TEXT": str,
+}
 
 
 def cast_metadata_type(in_value: Any, in_parameters: dict) -> Any:
@@ -51,3 +74,44 @@ def cast_metadata_type(in_value: Any, in_parameters: dict) -> Any:
         return in_value
 
     return typedict[out_type](in_value)
+
+
+@lru_cache
+def _datamodel_casts(datamodel: str) -> dict[tuple[str, str], Callable[[Any], Any]]:
+    """Return the cast functions for the typed properties of the record types in the data model.
+
+    The data model file is only read and compiled once, on the first call.  Properties without a
+    datatype, or with a datatype without cast function (references, lists, dates), are left out.
+    """
+    with open(datamodel, encoding="utf-8") as yaml_file:
+        model = yaml.safe_load(yaml_file)
+    casts = {}
+    for record_type, definition in model.items():
+        if not isinstance(definition, dict):
+            continue
+        for importance in ("obligatory_properties", "recommended_properties",
+                           "suggested_properties"):
+            for prop, prop_definition in (definition.get(importance) or {}).items():
+                datatype = (prop_definition or {}).get("datatype")
+                if datatype in DATATYPE_CASTS:
+                    casts[(record_type, prop)] = DATATYPE_CASTS[datatype]
+    return casts
+
+
+def cast_datamodel_type(in_value: Any, in_parameters: dict) -> Any:
+    """
+    Cast `in_value` to the datatype of the property in_parameters["property"] of the record type
+    in_parameters["record_type"], as defined in the data model (by default the RuQaD
+    `datamodel.yaml`, can be given as in_parameters["datamodel"]).
+
+    DOUBLE, INTEGER, BOOLEAN and TEXT properties are cast to float, int, bool and str.  Values of
+    other properties are returned unchanged.
+    """
+    try:
+        key = (in_parameters["record_type"], in_parameters["property"])
+    except KeyError as missing:
+        raise RuntimeError(f"Parameter `{missing.args[0]}` missing.") from missing
+    cast = _datamodel_casts(in_parameters.get("datamodel", DEFAULT_DATAMODEL)).get(key)
+    if cast is None:
+        return in_value
+    return cast(in_value)
@@ -18,16 +18,29 @@
 utilities to create .eln exports for certain records hosted in a Kadi instance
 """
 from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from kadi_apy import KadiManager as _KadiManager
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import sleep
+from typing import Optional
+
+from ruqad import tracing
 
 PAGE_SIZE = 100
+# Size of the chunks in which exported records are written to disk.
+CHUNK_SIZE = 1_000_000
+# Longest pause in seconds before a retry which is accepted from a Retry-After header.
+MAX_RETRY_AFTER = 300
 
 
 def _generate_pages(manager) -> dict:
     """
     Generates JSON responses (dict) that represent single pages returned by the Kadi API
 
+    The records are sorted by creation date, newest first.  The pages are requested lazily, one
+    request per page, so a consumer which stops early does not cause further requests.
+
     Paremters
     ---------
     manager: KadiManager, KadiManager instance used to connect to the Kadi API
@@ -37,19 +50,21 @@ def _generate_pages(manager) -> dict:
         dict, the JSON response as dict
     """
     query_params = {"per_page": PAGE_SIZE, "sort": "-created_at"}
-    # test search to get number of pages.
-    response = manager.search.search_resources("record", **query_params).json()
-    if 'code' in response and response['code'] != 200:
-        raise RuntimeError("Could not search Kadi. Connection returned code:"
-                           + str(response['code']))
-    n_pages = response["_pagination"]["total_pages"]
-    for ii in range(n_pages):
-        query_params.update({"page": ii + 1})
-        yield manager.search.search_resources("record", **query_params).json()
+    page = 1
+    while True:
+        query_params.update({"page": page})
+        response = manager.search.search_resources("record", **query_params).json()
+        if 'code' in response and response['code'] != 200:
+            raise RuntimeError("Could not search Kadi. Connection returned code:"
+                               + str(response['code']))
+        yield response
+        if page >= response["_pagination"]["total_pages"]:
+            break
+        page += 1
 
 
-def collect_records_created_after(manager: KadiManager,
-                                  cut_off_date: datetime.datetime) -> list(int):
+def collect_record_dates_created_after(manager: KadiManager,
+                                       cut_off_date: datetime.datetime) -> list(tuple):
     """
     Iterates page-wise over the responses of the Kadi API until records are reached that are older
     than the given cut_off_date.
@@ -62,19 +77,99 @@ def collect_records_created_after(manager: KadiManager,
 
     Returns
     -------
-        list(int), list of IDs of records that were created after the given cut_off_date
+        list(tuple(int, datetime)), list of IDs and creation dates of records that were created
+        after the given cut_off_date, newest first
     """
-    record_ids = []
+    records = []
     done = False
     for response in _generate_pages(manager):
         for el in response["items"]:
-            if cut_off_date > datetime.fromisoformat(el["created_at"]):
+            created_at = datetime.fromisoformat(el["created_at"])
+            if cut_off_date > created_at:
                 done = True
                 break
-            record_ids.append(el["id"])
+            records.append((el["id"], created_at))
         if done:
             break
-    return record_ids
+    return records
+
+
+def collect_records_created_after(manager: KadiManager,
+                                  cut_off_date: datetime.datetime) -> list(int):
+    """
+    Iterates page-wise over the responses of the Kadi API until records are reached that are older
+    than the given cut_off_date.
+
+    Paremters
+    ---------
+    manager: KadiManager, KadiManager instance used to connect to the Kadi API
+    cut_off_date: datetime, Records that were created after this date are included in the returned
+                 list
+
+    Returns
+    -------
+        list(int), list of IDs of records that were created after the given cut_off_date
+    """
+    return [rid for rid, _ in collect_record_dates_created_after(manager, cut_off_date)]
+
+
+def _retry_after(response) -> Optional[float]:
+    """Return the seconds to wait according to the Retry-After header, or None if there is none."""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def _export_eln(manager: KadiManager, rid: int, path: str, retries: int = 3,
+                backoff: float = 1.0) -> None:
+    """
+    Export a record as '.eln' file, streaming the response to ``path``.
+
+    The request goes directly to the export endpoint over the session of the manager, without
+    retrieving the record first.  Connection errors, rate limiting (429) and server errors (5xx)
+    are retried, with exponentially growing pauses or after the time given in the Retry-After
+    header.
+
+    Paremters
+    ---------
+    manager: KadiManager, KadiManager instance used to connect to the Kadi API
+    rid: int, ID of the record to be exported
+    path: str, the path where the file will be stored
+    retries: int, how often a failed export is retried
+    backoff: float, seconds to wait before the first retry, doubled for each further retry
+    """
+    delay = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            sleep(delay if delay is not None else backoff * 2 ** (attempt - 1))
+        delay = None
+        try:
+            # The response is closed in any case, so that the connection goes back to the pool.
+            with tracing.span("kadi_export", record_id=rid, attempt=attempt), \
+                    manager.make_request(f"/records/{rid}/export/ro-crate",
+                                         stream=True) as response:
+                if response.status_code == 200:
+                    with open(path, "wb") as fileobj:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            fileobj.write(chunk)
+                    return
+                error = RuntimeError(f"Could not export record {rid}. Connection returned code:"
+                                     + str(response.status_code))
+                if response.status_code == 429:
+                    delay = _retry_after(response)
+                elif response.status_code < 500:
+                    break
+        except OSError as err:
+            error = err
+    raise error
 
 
 def download_eln_for(manager: KadiManager, rid: int, path: str) -> None:
@@ -87,8 +182,37 @@ def download_eln_for(manager: KadiManager, rid: int, path: str) -> None:
     rid: int, ID of the record to be exported
     path: str, the path where the file will be stored
     """
-    rec = manager.record(id=rid)
-    rec.export(path=path, export_type='ro-crate')
+    _export_eln(manager, rid, path)
+
+
+def download_elns_for(manager: KadiManager, paths: dict, max_workers: int = 4,
+                      retries: int = 3, backoff: float = 1.0) -> dict:
+    """
+    Downloads several records as '.eln' files concurrently.
+
+    All downloads share the connection pool of the manager's session and are streamed directly to
+    disk.
+
+    Paremters
+    ---------
+    manager: KadiManager, KadiManager instance used to connect to the Kadi API
+    paths: dict(int, str), the path where the file will be stored, for each record ID
+    max_workers: int, the maximum number of concurrent downloads
+    retries: int, how often a failed export is retried
+    backoff: float, seconds to wait before the first retry, doubled for each further retry
+
+    Returns
+    -------
+        dict(int, Exception), the errors of the failed downloads, by record ID
+    """
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_export_eln, manager, rid, path, retries, backoff): rid
+                   for rid, path in paths.items()}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                errors[futures[future]] = future.exception()
+    return errors
 
 
 class KadiManager(_KadiManager):
@@ -0,0 +1,222 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Metrics of the monitor, in the Prometheus text exposition format.
+
+The metrics are always collected, which is cheap.  They are only exposed over HTTP if
+``start_metrics_server`` is called, which ``rq_monitor`` does if ``MONITOR_METRICS_PORT`` is set.
+"""
+
+from __future__ import annotations
+
+import bisect
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Iterator, Optional
+
+from ruqad import tracing
+
+_REGISTRY: list[_Metric] = []
+
+# Bucket bounds in seconds, from fast API requests up to long pipeline runs.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...],
+                   extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {labels}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """A value which only increases, e.g. the number of processed records."""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge(_Metric):
+    """A value which can go up and down, e.g. the number of records in progress."""
+
+    type_name = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(_Metric):
+    """The distribution of observed values, e.g. durations, in cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str):
+        """Observe the duration of the ``with`` block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def _samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield (f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} "
+                       f"{cumulative}")
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+POLL_DURATION = Histogram("ruqad_poll_duration_seconds",
+                          "Duration of the searches for new records in Kadi.")
+RECORDS_DISCOVERED = Counter("ruqad_records_discovered_total",
+                             "New records found in Kadi.")
+RECORDS_PROCESSED = Counter("ruqad_records_processed_total",
+                            "Records which were processed, by final status.", ("status",))
+RECORDS_PENDING = Gauge("ruqad_records_pending",
+                        "Records which were discovered but are not processed yet.")
+STAGE_DURATION = Histogram("ruqad_stage_duration_seconds",
+                           "Duration of the processing stages.", ("stage",))
+BYTES_TRANSFERRED = Counter("ruqad_bytes_transferred_total",
+                            "Bytes transferred, by transfer.", ("transfer",))
+ERRORS = Counter("ruqad_errors_total", "Errors, by stage.", ("stage",))
+WEBHOOK_EVENTS = Counter("ruqad_webhook_events_total",
+                         "Notifications received by the webhook receiver, by event.", ("event",))
+
+
+@contextmanager
+def stage(name: str):
+    """Observe the duration of a processing stage and count it as error if it raises.
+
+    The stage is also recorded as tracing span of the same name.
+    """
+    try:
+        with tracing.span(name), STAGE_DURATION.time(stage=name):
+            yield
+    except Exception:
+        ERRORS.inc(stage=name)
+        raise
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    return "".join(metric.render() for metric in _REGISTRY)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int, addr: str = "") -> ThreadingHTTPServer:
+    """Serve the metrics at ``http://<addr>:<port>/metrics`` from a background thread."""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -26,14 +26,20 @@ import traceback
 import shutil
 import os
 
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from threading import BoundedSemaphore
+from time import monotonic, sleep
 from tempfile import TemporaryDirectory
-from datetime import datetime, timezone
+from datetime import datetime, timedelta
 from pathlib import Path
 
+from ruqad import metrics, tracing
 from ruqad.qualitycheck import QualityChecker
-from ruqad.kadi import collect_records_created_after, download_eln_for, KadiManager
+from ruqad.kadi import collect_record_dates_created_after, download_eln_for, KadiManager
 from ruqad.crawler import trigger_crawler
+from ruqad.state import MonitorState
+from ruqad.webhook import RecordQueue, start_webhook_receiver
 
 KADIARGS = {
     "host": os.environ['KADIHOST'],
@@ -42,6 +48,261 @@ KADIARGS = {
 
 SKIP_QUALITY_CHECK = os.getenv("SKIP_QUALITY_CHECK") is not None
 
+# SQLite file for the cut off date and the status of each record.  Without it, the monitor starts
+# from scratch after each restart.
+MONITOR_STATE_FILE = os.getenv("MONITOR_STATE_FILE", ":memory:")
+
+# Number of records which are processed concurrently.
+MONITOR_WORKERS = int(os.getenv("MONITOR_WORKERS", "1"))
+
+# Larger numbers of new records are processed in batches of this size, with a pause of
+# MONITOR_BATCH_PAUSE seconds between the batches.
+MONITOR_BATCH_SIZE = int(os.getenv("MONITOR_BATCH_SIZE", "25"))
+MONITOR_BATCH_PAUSE = float(os.getenv("MONITOR_BATCH_PAUSE", "10"))
+
+# Records which failed are retried in the next polls, until they failed this often.
+MONITOR_MAX_ATTEMPTS = int(os.getenv("MONITOR_MAX_ATTEMPTS", "3"))
+
+# Maximum number of concurrent calls for each stage, to protect Kadi, GitLab and LinkAhead.
+# Each quality check uses its own S3 key prefix.  Concurrent checks need a pipeline which reads its
+# data from the RUQAD_S3_PREFIX variable, so by default only one check runs at a time.
+STAGE_LIMITS = {
+    "download": BoundedSemaphore(int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "4"))),
+    "qualitycheck": BoundedSemaphore(int(os.getenv("MAX_CONCURRENT_CHECKS", "1"))),
+    "crawler": BoundedSemaphore(int(os.getenv("MAX_CONCURRENT_CRAWLS", "1"))),
+}
+
+# If set, the metrics are served in the Prometheus format at http://<host>:<port>/metrics.
+MONITOR_METRICS_PORT = os.getenv("MONITOR_METRICS_PORT")
+
+# If set, notifications about created or updated records are received at
+# http://<MONITOR_WEBHOOK_ADDR>:<port>/events, and the records are processed right away.  If
+# MONITOR_WEBHOOK_TOKEN is set, the notifications must send it in the X-Ruqad-Token header.  It is
+# required unless the receiver only listens on the local host, which is the default.
+MONITOR_WEBHOOK_PORT = os.getenv("MONITOR_WEBHOOK_PORT")
+MONITOR_WEBHOOK_ADDR = os.getenv("MONITOR_WEBHOOK_ADDR", "127.0.0.1")
+MONITOR_WEBHOOK_TOKEN = os.getenv("MONITOR_WEBHOOK_TOKEN")
+
+# Seconds between two searches for new records.  With notifications, the search is only a fallback
+# for missed notifications and runs less often by default.
+MONITOR_POLL_INTERVAL = float(os.getenv("MONITOR_POLL_INTERVAL",
+                                        "900" if MONITOR_WEBHOOK_PORT else "60"))
+
+# If set, a trace of the processing of each record is appended to this file, in the format
+# MONITOR_TRACE_FORMAT ("chrome" or "otlp").
+MONITOR_TRACE_FILE = os.getenv("MONITOR_TRACE_FILE")
+MONITOR_TRACE_FORMAT = os.getenv("MONITOR_TRACE_FORMAT", "chrome")
+
+
+@contextmanager
+def _limited(stage: str):
+    """Hold one of the ``STAGE_LIMITS`` of the stage.  The time spent waiting for it is traced."""
+    with tracing.span(f"{stage}_queue"):
+        STAGE_LIMITS[stage].acquire()
+    try:
+        yield
+    finally:
+        STAGE_LIMITS[stage].release()
+
+
+def _process_record(manager: KadiManager, rid: int, state: MonitorState):
+    """Download, check and crawl a single record.
+
+    Parameters
+    ----------
+    manager : KadiManager
+      Connection to the Kadi instance.
+
+    rid : int
+      The ID of the record.
+
+    state : MonitorState
+      The status of the record is stored here after each step.
+
+    If tracing is enabled, the processing of the record is traced with a span for each stage.
+    """
+    with tracing.trace(rid), TemporaryDirectory(delete=False) as cdir:
+        eln_file = os.path.join(cdir, "export.eln")
+        with _limited("download"), metrics.stage("kadi_download"):
+            download_eln_for(manager, rid, path=eln_file)
+        metrics.BYTES_TRANSFERRED.inc(os.path.getsize(eln_file), transfer="kadi_download")
+        state.set_status(rid, "downloaded")
+        print(f"Downlaoded {eln_file}")
+        if SKIP_QUALITY_CHECK:
+            print("Found env 'SKIP_QUALITY_CHECK', skipping quality check")
+        else:
+            with _limited("qualitycheck"), tracing.span("quality_check"):
+                qc = QualityChecker()
+                qc.check(filename=eln_file, target_dir=cdir, record_id=rid)
+            state.set_status(rid, "checked")
+            print(f"Quality check done. {os.listdir(cdir)}")
+        # trigger crawler on dir
+        remote_dir_path = os.path.join(cdir, "ruqad", str(rid))
+        os.makedirs(remote_dir_path)
+        if os.path.exists(os.path.join(cdir, "artifacts.zip")):
+            shutil.move(os.path.join(cdir, "artifacts.zip"),
+                        os.path.join(remote_dir_path, "report.zip"))
+        # else:
+        #    Path(os.path.join(remote_dir_path, "report.zip")).touch()
+        shutil.move(os.path.join(cdir, "export.eln"),
+                    os.path.join(remote_dir_path, "export.eln"))
+        with _limited("crawler"), tracing.span("crawler"):
+            trigger_crawler(target_dir=cdir)
+        state.set_status(rid, "crawled")
+
+
+def _should_process(rid: int, state: MonitorState, updated: bool = False) -> bool:
+    """Whether the record was neither crawled yet nor failed ``MONITOR_MAX_ATTEMPTS`` times.
+
+    Updated records are processed again even if they were crawled, but not after too many failures.
+    """
+    status = state.get_status(rid)
+    if status == "failed":
+        return state.get_attempts(rid) < MONITOR_MAX_ATTEMPTS
+    return updated or status != "crawled"
+
+
+def _process_records(manager: KadiManager, rec_ids: list[int], state: MonitorState) -> list[int]:
+    """Process the records with a pool of ``MONITOR_WORKERS`` threads.
+
+    Each record goes through download, quality check and crawling independently of the others.  A
+    failing record does not stop the other records.
+
+    Returns
+    -------
+    out : list[int]
+      The IDs of the records which failed.
+    """
+    failed = []
+    with ThreadPoolExecutor(max_workers=MONITOR_WORKERS) as executor:
+        futures = {executor.submit(_process_record, manager, rid, state): rid
+                   for rid in rec_ids}
+        for future in as_completed(futures):
+            metrics.RECORDS_PENDING.dec()
+            try:
+                future.result()
+                metrics.RECORDS_PROCESSED.inc(status="crawled")
+            except Exception as e:
+                print(f"ERROR while processing record {futures[future]}")
+                print(traceback.format_exc())
+                print(e)
+                state.set_status(futures[future], "failed")
+                metrics.RECORDS_PROCESSED.inc(status="failed")
+                failed.append(futures[future])
+    return failed
+
+
+def _process_new_records(manager: KadiManager, cut_off_date: datetime,
+                         state: MonitorState) -> datetime:
+    """Process all records created after ``cut_off_date``, in batches of ``MONITOR_BATCH_SIZE``.
+
+    The records are processed from the oldest to the newest.  After each batch, the cut off date is
+    advanced and stored, so that an interruption does not lose records.  It is only advanced up to
+    the oldest record which failed, so that the failed record and all newer ones are searched for
+    again in the next call.  Records which were already crawled are skipped.
+
+    Failed records from the state which are not found by the search (e.g. notified records) are
+    retried as well.  Records which failed ``MONITOR_MAX_ATTEMPTS`` times are given up and do not
+    hold back the cut off date any longer.
+
+    Parameters
+    ----------
+    manager : KadiManager
+      Connection to the Kadi instance.
+
+    cut_off_date : datetime
+      Only records which were created after this date are processed.
+
+    state : MonitorState
+      The stored cut off date and status of each record.
+
+    Returns
+    -------
+    out : datetime
+      The new cut off date: the creation date of the newest record before which all records were
+      processed successfully.
+    """
+    with metrics.POLL_DURATION.time():
+        found = collect_record_dates_created_after(manager, cut_off_date)
+    found = sorted(((rid, created_at) for rid, created_at in found if created_at > cut_off_date),
+                   key=lambda record: record[1])
+    records = [(rid, created_at) for rid, created_at in found if _should_process(rid, state)]
+    found_ids = {rid for rid, _ in found}
+    retry = [rid for rid in state.records_with_status("failed", max_attempts=MONITOR_MAX_ATTEMPTS)
+             if rid not in found_ids]
+    metrics.RECORDS_DISCOVERED.inc(len(records))
+    metrics.RECORDS_PENDING.set(len(records) + len(retry))
+    if retry:
+        print(f"Retrying failed records {retry}")
+        _process_records(manager, retry, state)
+    if len(records) == 0:
+        print("no new recs")
+    failed: set[int] = set()
+    for start in range(0, len(records), MONITOR_BATCH_SIZE):
+        if start > 0:
+            print(f"{len(records) - start} new records left, pausing for "
+                  f"{MONITOR_BATCH_PAUSE} s.")
+            sleep(MONITOR_BATCH_PAUSE)
+        batch = records[start:start + MONITOR_BATCH_SIZE]
+        failed.update(rid for rid in _process_records(manager, [rid for rid, _ in batch], state)
+                      if state.get_attempts(rid) < MONITOR_MAX_ATTEMPTS)
+        cut_off_date = _advance_cut_off_date(cut_off_date, found, failed, until=batch[-1][1])
+        state.set_cut_off_date(cut_off_date)
+    if found:
+        # Also past the records which were crawled before.
+        cut_off_date = _advance_cut_off_date(cut_off_date, found, failed, until=found[-1][1])
+        state.set_cut_off_date(cut_off_date)
+    return cut_off_date
+
+
+def _advance_cut_off_date(cut_off_date: datetime, records: list[tuple[int, datetime]],
+                          failed: set[int], until: datetime) -> datetime:
+    """Return the creation date of the newest record up to ``until`` before the oldest failed one.
+
+    ``records`` are the IDs and creation dates of the found records, sorted by the date.  If a
+    record failed, the returned date is before its creation date, also if other records were
+    created at the same time.
+    """
+    for rid, created_at in records:
+        if created_at > until:
+            break
+        if rid in failed:
+            return min(cut_off_date, created_at - timedelta(microseconds=1))
+        cut_off_date = created_at
+    return cut_off_date
+
+
+def _process_notified_records(manager: KadiManager, events: dict[int, str],
+                              state: MonitorState) -> list[int]:
+    """Process the records from notifications.
+
+    Records which failed ``MONITOR_MAX_ATTEMPTS`` times are skipped, and so are created records
+    which were crawled already, e.g. by the search for new records.  Updated records which were
+    crawled are processed again.
+    Records which fail are retried by ``_process_new_records``.
+
+    Parameters
+    ----------
+    manager : KadiManager
+      Connection to the Kadi instance.
+
+    events : dict[int, str]
+      The event of each notified record ID, as returned by ``RecordQueue.take``.
+
+    state : MonitorState
+      The status of each record.
+
+    Returns
+    -------
+    out : list[int]
+      The IDs of the records which failed.
+    """
+    rec_ids = [rid for rid, event in events.items()
+               if _should_process(rid, state, updated=event == "record.updated")]
+    metrics.RECORDS_DISCOVERED.inc(len(rec_ids))
+    metrics.RECORDS_PENDING.inc(len(rec_ids))
+    return _process_records(manager, rec_ids, state)
+
 
 def monitor():
     """Continuously monitor the Kadi instance given in the environment variables.
@@ -51,44 +312,48 @@ def monitor():
     - Download the eln-format wrapped item.
     - Run the quality check.
     - Run the crawler on the item and the quality check result.
+
+    If ``MONITOR_STATE_FILE`` is set, the monitor resumes from the state stored there.  If
+    ``MONITOR_METRICS_PORT`` is set, the metrics are served on this port.  If
+    ``MONITOR_TRACE_FILE`` is set, a trace of each record is written to this file.
+
+    If ``MONITOR_WEBHOOK_PORT`` is set, notified records are processed as soon as the
+    notification arrives, and the search for new records is only a fallback which runs every
+    ``MONITOR_POLL_INTERVAL`` seconds.
     """
-    cut_off_date = datetime.fromisoformat("1990-01-01 02:34:42.484312+00:00")
+    if MONITOR_TRACE_FILE:
+        tracing.configure(MONITOR_TRACE_FILE, MONITOR_TRACE_FORMAT)
+        print(f"Writing traces to {MONITOR_TRACE_FILE}")
+    if MONITOR_METRICS_PORT:
+        metrics.start_metrics_server(int(MONITOR_METRICS_PORT))
+        print(f"Serving metrics at port {MONITOR_METRICS_PORT}, path /metrics")
+    queue = None
+    if MONITOR_WEBHOOK_PORT:
+        queue = RecordQueue()
+        start_webhook_receiver(queue, int(MONITOR_WEBHOOK_PORT), addr=MONITOR_WEBHOOK_ADDR,
+                               token=MONITOR_WEBHOOK_TOKEN)
+        print(f"Receiving notifications at {MONITOR_WEBHOOK_ADDR or '*'}:{MONITOR_WEBHOOK_PORT}, "
+              "path /events")
+    state = MonitorState(MONITOR_STATE_FILE)
+    cut_off_date = state.get_cut_off_date()
+    if cut_off_date is None:
+        cut_off_date = datetime.fromisoformat("1990-01-01 02:34:42.484312+00:00")
+    next_poll = monotonic()
     while True:
         try:
-            timestamp = datetime.now(timezone.utc)
-            with KadiManager(**KADIARGS) as manager:
-                print(f"Checking for records created after {cut_off_date}...")
-                rec_ids = collect_records_created_after(manager, cut_off_date)
-                cut_off_date = timestamp
-
-                if len(rec_ids) > 25:
-                    print("skipping, too many recs: ", len(rec_ids))
-                    continue
-                if len(rec_ids) == 0:
-                    print("no new recs")
-                for rid in rec_ids:
-                    with TemporaryDirectory(delete=False) as cdir:
-                        eln_file = os.path.join(cdir, "export.eln")
-                        download_eln_for(manager, rid, path=eln_file)
-                        print(f"Downlaoded {eln_file}")
-                        if SKIP_QUALITY_CHECK:
-                            print("Found env 'SKIP_QUALITY_CHECK', skipping quality check")
-                        else:
-                            qc = QualityChecker()
-                            qc.check(filename=eln_file, target_dir=cdir)
-                            print(f"Quality check done. {os.listdir(cdir)}")
-                        # trigger crawler on dir
-                        remote_dir_path = os.path.join(cdir, "ruqad", str(rid))
-                        os.makedirs(remote_dir_path)
-                        if os.path.exists(os.path.join(cdir, "artifacts.zip")):
-                            shutil.move(os.path.join(cdir, "artifacts.zip"),
-                                        os.path.join(remote_dir_path, "report.zip"))
-                        # else:
-                        #    Path(os.path.join(remote_dir_path, "report.zip")).touch()
-                        shutil.move(os.path.join(cdir, "export.eln"),
-                                    os.path.join(remote_dir_path, "export.eln"))
-                        trigger_crawler(target_dir=cdir)
-            sleep(60)
+            if monotonic() >= next_poll:
+                next_poll = monotonic() + MONITOR_POLL_INTERVAL
+                with KadiManager(**KADIARGS) as manager:
+                    print(f"Checking for records created after {cut_off_date}...")
+                    cut_off_date = _process_new_records(manager, cut_off_date, state)
+            if queue is None:
+                sleep(max(next_poll - monotonic(), 0))
+                continue
+            events = queue.take(timeout=max(next_poll - monotonic(), 0))
+            if events:
+                with KadiManager(**KADIARGS) as manager:
+                    print(f"Processing notified records {sorted(events)}")
+                    _process_notified_records(manager, events, state)
 
         except KeyboardInterrupt as e:
             raise e
@@ -21,20 +21,34 @@
 """
 """
 
-# TODO Use Gitlab Python module instead of curl. Or at least the requests module.
-
 import argparse
-import json
+import asyncio
+import heapq
 import os
+import shutil
 import time
+import zlib
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
-from subprocess import run
-from tempfile import TemporaryDirectory
+from threading import Condition, Thread
 from typing import Optional
-from zipfile import ZipFile
+from uuid import uuid4
+from zipfile import BadZipFile, ZipInfo
 
 import boto3
+import requests
 import toml
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from ruqad import metrics, tracing
+from ruqad.archive import ArchiveLimits, SafeArchive, UnsafeArchive
+from ruqad.resultcache import ResultCache, content_key, is_data_member
 
 
 def read_config() -> dict:
@@ -45,6 +59,35 @@ This config file must define the following:
 - ``s3_endpoint``: S3 endpoint to connect to.
 - ``s3_bucket``: Bucket in the S3 Service.
 
+Optionally, it may define the following:
+
+- ``s3_upload_workers``: Number of files which are uploaded concurrently.  Default: 8
+- ``s3_multipart_threshold``: Files larger than this (in bytes) are uploaded in parts.
+  Default: 8 MiB
+- ``s3_multipart_chunksize``: Size of the parts (in bytes).  Default: 8 MiB
+- ``s3_multipart_concurrency``: Number of parts of a file which are uploaded concurrently.
+  Default: 4
+- ``gitlab_api_url``: URL of the GitLab API.  Default: ``https://gitlab.indiscale.com/api/v4``
+- ``gitlab_project_id``: ID of the GitLab project which runs the checks.  Default: 268
+- ``gitlab_timeout``: Timeout in seconds for requests to GitLab.  Default: 30
+- ``gitlab_poll_min_delay``: Shortest delay in seconds between two polls of a pipeline.  Default: 2
+- ``gitlab_poll_max_delay``: Longest delay in seconds between two polls of a pipeline.
+  Default: 60
+- ``gitlab_max_requests_per_second``: Budget for the status requests of all pipelines together.
+  Default: 2
+- ``gitlab_pipeline_timeout``: Longest time in seconds to wait for a pipeline to finish.
+  Default: 7200
+- ``result_cache_dir``: Directory for caching the results of successful checks.  Default: no cache
+- ``result_cache_max_size``: Maximum size of the result cache in bytes.  Default: 1 GiB
+- ``result_cache_max_age``: Results which were not used for this many seconds are removed.
+  Default: 30 days
+- ``result_extract_members``: File names of members of the result archive which are also
+  extracted next to it, for example ``["qc_summary.json"]``.  Default: none
+- ``archive_max_total_size``, ``archive_max_ratio``, ``archive_max_members``: Limits for the
+  checked archives, see ``ruqad.archive.ArchiveLimits``.  Archives exceeding them are rejected.
+- ``checker_version``: Version of the checks, results of other versions are not reused from the
+  cache.  Default: the version of this package
+
 Returns
 -------
 out: dict
@@ -59,6 +102,311 @@ out: dict
     return config
 
 
+@lru_cache
+def _get_s3_client(endpoint: str, access_key_id: str, secret_access_key: str,
+                   max_pool_connections: int):
+    """Return an S3 client.
+
+The clients are shared by all QualityCheckers with the same parameters, so that they also share the
+connection pool.
+    """
+    session = boto3.Session(aws_access_key_id=access_key_id,
+                            aws_secret_access_key=secret_access_key)
+    return session.client("s3", endpoint_url=endpoint,
+                          config=Config(max_pool_connections=max_pool_connections))
+
+
+class GitlabClient:
+    """Minimal client for the GitLab API of the quality check project.
+
+All requests go over one persistent session, so connections are kept alive and reused.  Requests
+which fail with connection errors or with server errors are retried.
+    """
+
+    def __init__(self, api_url: str, project_id: int, api_token: str, timeout: float = 30,
+                 retries: int = 3):
+        """
+Parameters
+----------
+api_url : str
+  The base URL of the GitLab API, for example ``https://gitlab.example.com/api/v4``.
+
+project_id : int
+  The ID of the project which runs the quality checks.
+
+api_token : str
+  Token for the API access.
+
+timeout : float, default=30
+  Timeout in seconds for connecting and for waiting for data.
+
+retries : int, default=3
+  How often failed requests are retried.
+        """
+        self._project_url = f"{api_url.rstrip('/')}/projects/{project_id}"
+        self._api_token = api_token
+        self._timeout = timeout
+        self._session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def _get(self, path: str, **kwargs) -> requests.Response:
+        headers = {"PRIVATE-TOKEN": self._api_token, **kwargs.pop("headers", {})}
+        return self._session.get(self._project_url + path, timeout=self._timeout,
+                                 headers=headers, **kwargs)
+
+    def trigger_pipeline(self, token: str, ref: str, variables: Optional[dict] = None) -> dict:
+        """Trigger a new pipeline with a pipeline trigger token and return its description."""
+        data = {"token": token, "ref": ref}
+        for key, value in (variables or {}).items():
+            data[f"variables[{key}]"] = value
+        response = self._session.post(self._project_url + "/trigger/pipeline", data=data,
+                                      timeout=self._timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def get_pipeline(self, pipeline_id: str) -> dict:
+        """Return the description of the pipeline.  Raises HTTPError if GitLab returns an error."""
+        response = self._get(f"/pipelines/{pipeline_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def get_pipeline_jobs(self, pipeline_id: str) -> list[dict]:
+        """Return the descriptions of the jobs of the pipeline.  Raises HTTPError if GitLab returns
+an error."""
+        response = self._get(f"/pipelines/{pipeline_id}/jobs")
+        response.raise_for_status()
+        return response.json()
+
+    def download_artifacts(self, job_id: str, target: str, attempts: int = 3,
+                           limits: Optional[ArchiveLimits] = None):
+        """Download the artifacts archive of the job to the file ``target``.
+
+The archive is streamed to ``<target>.part``.  If the connection breaks, the download is resumed
+from where it stopped with a range request.  Only a complete archive which is within the limits and
+whose members all pass the CRC check is moved to ``target``.
+
+Parameters
+----------
+job_id : str
+  The ID of the job with the artifacts.
+
+target : str
+  The file name of the downloaded archive.
+
+attempts : int, default=3
+  How often the download is started or resumed before giving up, at least 1.
+
+limits : Optional[ArchiveLimits]
+  The archive is checked against these limits (by default the default limits) before any member
+  is decompressed.  If it exceeds them, ``UnsafeArchive`` is raised without further attempts.
+        """
+        if attempts < 1:
+            raise ValueError(f"At least one attempt is needed, got {attempts}.")
+        error: Optional[Exception] = None
+        part = target + ".part"
+        if os.path.exists(part):
+            os.remove(part)
+        for attempt in range(1, attempts + 1):
+            try:
+                self._download_part(f"/jobs/{job_id}/artifacts", part)
+                _verify_zip(part, limits)
+                break
+            except UnsafeArchive:
+                os.remove(part)
+                raise
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, IncompleteDownload) as exc:
+                print(f"Download of artifacts of job {job_id} interrupted "
+                      f"(attempt {attempt}/{attempts}): {exc}")
+                error = exc
+            except BadZipFile as exc:
+                print(f"Downloaded artifacts of job {job_id} are broken "
+                      f"(attempt {attempt}/{attempts}): {exc}")
+                os.remove(part)
+                error = exc
+        else:
+            raise RuntimeError(f"Could not download the artifacts of job {job_id}.") from error
+        os.replace(part, target)
+
+    def _download_part(self, path: str, part: str):
+        """Download into the file ``part``, continuing after the data which it already contains."""
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with self._get(path, stream=True, headers=headers) as response:
+            if response.status_code == 416:  # Range not satisfiable: nothing is missing.
+                return
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            expected = None
+            if "Content-Length" in response.headers:
+                expected = offset + int(response.headers["Content-Length"])
+            with open(part, "ab" if offset else "wb") as fileobj:
+                for chunk in response.iter_content(chunk_size=1024**2):
+                    fileobj.write(chunk)
+        size = os.path.getsize(part)
+        if expected is not None and size != expected:
+            raise IncompleteDownload(f"Got {size} of {expected} bytes.")
+
+
+class IncompleteDownload(IOError):
+    """The download ended before all data was received."""
+
+
+def _verify_zip(filename: str, limits: Optional[ArchiveLimits] = None):
+    """Raise BadZipFile unless the central directory can be read and all members pass the CRC.
+
+The central directory is checked against the limits first, so UnsafeArchive is raised before any
+member is decompressed.
+    """
+    with SafeArchive(filename, limits) as archive:
+        for info in archive.members:
+            if info.is_dir():
+                continue
+            try:
+                # The CRC is checked when the end of the member is reached.
+                with archive.open(info) as member:
+                    while member.read(1024**2):
+                        pass
+            except (zlib.error, EOFError) as exc:
+                raise BadZipFile(f"Broken member {info.filename}: {exc}") from exc
+
+
+@lru_cache
+def _get_gitlab_client(api_url: str, project_id: int, api_token: str,
+                       timeout: float) -> GitlabClient:
+    """Return a GitLab client, shared by all QualityCheckers with the same parameters."""
+    return GitlabClient(api_url=api_url, project_id=project_id, api_token=api_token,
+                        timeout=timeout)
+
+
+class PipelineWatcher:
+    """Watch many pipelines with one thread and a common request budget.
+
+Each watched pipeline is polled with exponential backoff, starting from ``min_delay`` and doubling
+up to ``max_delay``.  Once pipelines have finished, the first poll of a new pipeline is only done
+shortly before the typical (exponentially averaged) pipeline duration has passed.  All status
+requests together stay below ``max_requests_per_second``.
+    """
+
+    def __init__(self, gitlab: GitlabClient, min_delay: float = 2, max_delay: float = 60,
+                 max_requests_per_second: float = 2):
+        """
+Parameters
+----------
+gitlab : GitlabClient
+  The client for the status requests.
+
+min_delay : float, default=2
+  The shortest delay in seconds between two polls of the same pipeline.
+
+max_delay : float, default=60
+  The longest delay in seconds between two polls of the same pipeline.
+
+max_requests_per_second : float, default=2
+  The budget for all status requests together.
+        """
+        self._gitlab = gitlab
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._request_interval = 1 / max_requests_per_second
+        self._condition = Condition()
+        # Heap of (next poll, pipeline ID, start, current delay, future)
+        self._schedule: list[tuple[float, str, float, float, Future]] = []
+        self._last_request = float("-inf")
+        # Exponential moving average of the pipeline durations, None until one has finished.
+        self.typical_duration: Optional[float] = None
+        self._thread: Optional[Thread] = None
+
+    def watch(self, pipeline_id: str) -> Future:
+        """Start watching a pipeline.
+
+Returns
+-------
+out : Future
+  Resolves to the last pipeline description returned by GitLab, once the pipeline has finished
+  or GitLab returned an error.  Resolves to an exception if the status could not be requested or
+  the response was not a pipeline description.  If the future is cancelled, the pipeline is not
+  polled any longer.
+        """
+        future: Future = Future()
+        now = time.monotonic()
+        delay = self._min_delay
+        if self.typical_duration is not None:
+            delay = min(max(0.8 * self.typical_duration, self._min_delay), self._max_delay)
+        with self._condition:
+            heapq.heappush(self._schedule, (now + delay, str(pipeline_id), now, self._min_delay,
+                                            future))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name="PipelineWatcher", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _next_due(self) -> tuple[str, float, float, Future]:
+        """Wait until the next pipeline is due and the budget allows a request, then pop it."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if not self._schedule:
+                    self._condition.wait()
+                    continue
+                due = max(self._schedule[0][0], self._last_request + self._request_interval)
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                self._last_request = now
+                _, pipeline_id, start, delay, future = heapq.heappop(self._schedule)
+                return pipeline_id, start, delay, future
+
+    def _run(self):
+        while True:
+            pipeline_id, start, delay, future = self._next_due()
+            if future.cancelled():  # The caller stopped waiting.
+                continue
+            try:
+                self._poll(pipeline_id, start, delay, future)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # Any error only concerns this pipeline, the others are still watched.
+                try:
+                    future.set_exception(exc)
+                except InvalidStateError:  # Cancelled in the meantime
+                    pass
+
+    def _poll(self, pipeline_id: str, start: float, delay: float, future: Future):
+        """Request the status of the pipeline and resolve ``future`` or schedule the next poll."""
+        result = self._gitlab.get_pipeline(pipeline_id)
+        if "error" in result or (result["status"] != "running"
+                                 and result["finished_at"] is not None):
+            self._record_duration(time.monotonic() - start)
+            try:
+                future.set_result(result)
+            except InvalidStateError:  # Cancelled in the meantime
+                pass
+            return
+        with self._condition:
+            heapq.heappush(self._schedule, (time.monotonic() + delay, pipeline_id, start,
+                                            min(2 * delay, self._max_delay), future))
+
+    def _record_duration(self, duration: float):
+        if self.typical_duration is None:
+            self.typical_duration = duration
+        else:
+            self.typical_duration = 0.8 * self.typical_duration + 0.2 * duration
+
+
+@lru_cache
+def _get_pipeline_watcher(gitlab: GitlabClient, min_delay: float, max_delay: float,
+                          max_requests_per_second: float) -> PipelineWatcher:
+    """Return a pipeline watcher, shared by all QualityCheckers with the same parameters."""
+    return PipelineWatcher(gitlab, min_delay=min_delay, max_delay=max_delay,
+                           max_requests_per_second=max_requests_per_second)
+
+
 class QualityChecker:
 
     class CheckFailed(RuntimeError):
@@ -87,13 +435,45 @@ class QualityChecker:
             raise RuntimeError("Missing environment variables.")
 
         self._bucketname = self._config["s3_bucket"]
-        session = boto3.Session(aws_access_key_id=self._config["s3_access_key_id"],
-                                aws_secret_access_key=self._config["s3_secret_access_key"])
-        self._s3_client = session.client("s3", endpoint_url=self._config["s3_endpoint"])
-
-    def check(self, filename: str, target_dir: str = ".") -> bool:
+        self._upload_workers = self._config.get("s3_upload_workers", 8)
+        multipart_concurrency = self._config.get("s3_multipart_concurrency", 4)
+        self._transfer_config = TransferConfig(
+            multipart_threshold=self._config.get("s3_multipart_threshold", 8 * 1024**2),
+            multipart_chunksize=self._config.get("s3_multipart_chunksize", 8 * 1024**2),
+            max_concurrency=multipart_concurrency)
+        self._s3_client = _get_s3_client(
+            self._config["s3_endpoint"], self._config["s3_access_key_id"],
+            self._config["s3_secret_access_key"],
+            max_pool_connections=self._upload_workers * multipart_concurrency)
+        self._gitlab = _get_gitlab_client(
+            self._config.get("gitlab_api_url", "https://gitlab.indiscale.com/api/v4"),
+            self._config.get("gitlab_project_id", 268),
+            self._config["gitlab_api_token"],
+            timeout=self._config.get("gitlab_timeout", 30))
+        self._watcher = _get_pipeline_watcher(
+            self._gitlab, self._config.get("gitlab_poll_min_delay", 2),
+            self._config.get("gitlab_poll_max_delay", 60),
+            self._config.get("gitlab_max_requests_per_second", 2))
+        self._archive_limits = ArchiveLimits.from_config(self._config)
+        self._result_cache: Optional[ResultCache] = None
+        if "result_cache_dir" in self._config:
+            self._result_cache = ResultCache(
+                self._config["result_cache_dir"],
+                max_size=self._config.get("result_cache_max_size", 1024**3),
+                max_age=self._config.get("result_cache_max_age", 30 * 86400))
+        # Statistics of the uploads: (key, size in bytes, duration in seconds)
+        self.upload_stats: list[tuple[str, int, float]] = []
+
+    def check(self, filename: str, target_dir: str = ".", record_id: Optional[int] = None) -> bool:
         """Check for data quality.
 
+Each check stores its data in the S3 bucket under its own key prefix
+``data/<record_id>/<uuid>/``, which is passed to the pipeline in the ``RUQAD_S3_PREFIX`` variable.
+Only this prefix is cleaned up afterwards, so several checks can run at the same time.
+
+If a result cache is configured and the same content was checked successfully before, the cached
+``artifacts.zip`` is used instead of running the checks again.
+
 Parameters
 ----------
 
@@ -103,18 +483,26 @@ filename : str
 target_dir : str, default="."
   Download to this directory.
 
+record_id : Optional[int]
+  The ID of the checked record, to be used in the key prefix.
+
 Returns
 -------
 out : bool
   True if the checks passed, false otherwise.
         """
-        # Prepare check
-        self._upload(filename)
+        found, cache_key = self._lookup_result(filename, target_dir)
+        if found:
+            return True
+        prefix = self._new_prefix(record_id)
 
-        # Actual check
         check_ok = True
         try:
-            pipeline_id = self._trigger_check()
+            # Prepare check
+            self._upload(filename, prefix=prefix)
+
+            # Actual check
+            pipeline_id = self._trigger_check(prefix=prefix)
             job_id = self._wait_for_check(pipeline_id=pipeline_id)
             self._download_result(job_id=job_id, target_dir=target_dir)
         except self.CheckFailed as cfe:
@@ -122,45 +510,167 @@ out : bool
             #breakpoint()
 
             check_ok = False
+        finally:
+            # Cleanup, also if the upload or the check raised, e.g. after a timeout
+            self._cleanup(prefix=prefix)
 
-        # Cleanup
-        self._cleanup()
+        if check_ok and cache_key is not None:
+            self._result_cache.put(cache_key, os.path.join(target_dir, "artifacts.zip"))
 
         return check_ok
 
-    def _cleanup(self):
-        """Clean up the S3 bucket.
+    async def check_async(self, filename: str, target_dir: str = ".",
+                          record_id: Optional[int] = None) -> bool:
+        """Check for data quality, like ``check``, but without blocking the event loop.
+
+The uploads, GitLab requests and downloads run in the default executor of the event loop, while
+waiting for the pipeline only awaits the shared pipeline watcher and does not occupy a thread.
+When many checks run concurrently in one event loop (e.g. with ``asyncio.gather``), the data of one
+record is uploaded while the pipelines of the others are running.
 
-This deletes all the objects in the bucket.
+The parameters, the return value and the handling of ``CheckFailed`` are the same as for
+``check``.
         """
-        objects = self._s3_client.list_objects_v2(Bucket=self._bucketname).get("Contents")
-        if objects is None:
-            # nothing to delete
-            return
-        for obj in objects:
-            self._s3_client.delete_object(Bucket=self._bucketname, Key=obj["Key"])
+        found, cache_key = await asyncio.to_thread(self._lookup_result, filename, target_dir)
+        if found:
+            return True
+        prefix = self._new_prefix(record_id)
+
+        check_ok = True
+        try:
+            # Prepare check
+            await asyncio.to_thread(self._upload, filename, prefix=prefix)
+
+            # Actual check
+            pipeline_id = await asyncio.to_thread(self._trigger_check, prefix=prefix)
+            job_id = await self._wait_for_check_async(pipeline_id=pipeline_id)
+            await asyncio.to_thread(self._download_result, job_id=job_id, target_dir=target_dir)
+        except self.CheckFailed as cfe:
+            print(f"Check failed:\nStatus: {cfe.reason['status']}")
+            check_ok = False
+        finally:
+            # Cleanup, also if the upload or the check raised, e.g. after a timeout
+            await asyncio.to_thread(self._cleanup, prefix=prefix)
+
+        if check_ok and cache_key is not None:
+            await asyncio.to_thread(self._result_cache.put, cache_key,
+                                    os.path.join(target_dir, "artifacts.zip"))
+
+        return check_ok
+
+    @staticmethod
+    def _new_prefix(record_id: Optional[int] = None) -> str:
+        """Return a new, unique S3 key prefix for a check."""
+        if record_id is not None:
+            return f"data/{record_id}/{uuid4()}/"
+        return f"data/{uuid4()}/"
+
+    def _lookup_result(self, filename: str, target_dir: str) -> tuple[bool, Optional[str]]:
+        """Look up the result for the content of ``filename`` in the result cache.
+
+Returns
+-------
+out : tuple[bool, Optional[str]]
+  Whether the cached result was stored as ``artifacts.zip`` in ``target_dir``, and the cache key
+  (None if there is no result cache).
+        """
+        if self._result_cache is None:
+            return False, None
+        with tracing.span("result_cache_lookup"):
+            cache_key = content_key(filename, self._checker_version(), self._archive_limits)
+            found = self._result_cache.get(cache_key, os.path.join(target_dir, "artifacts.zip"))
+        if found:
+            print(f"Reusing cached check result for {filename}")
+            self._extract_result_members(target_dir)
+            return True, cache_key
+        return False, cache_key
+
+    def _checker_version(self) -> str:
+        """The version of the checks, results of other versions are not reused."""
+        if "checker_version" in self._config:
+            return str(self._config["checker_version"])
+        try:
+            return version("ruqad")
+        except PackageNotFoundError:
+            return "unknown"
+
+    def _cleanup(self, prefix: str = ""):
+        """Clean up the S3 bucket.
+
+This deletes all the objects in the bucket, or only those whose keys start with ``prefix``.
 
-    def _extract_content(self, filename: str, upload: bool = False):
+The listing is paged through completely, and the objects of each page (at most 1000) are deleted
+with a single request.  These requests run concurrently.
+
+Parameters
+----------
+prefix : str, default=""
+  Only delete objects with this key prefix.
+        """
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        with tracing.span("s3_cleanup", prefix=prefix), \
+                ThreadPoolExecutor(self._upload_workers) as executor:
+            futures = []
+            for page in paginator.paginate(Bucket=self._bucketname, Prefix=prefix):
+                objects = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+                if objects:
+                    futures.append(executor.submit(self._delete_objects, objects))
+            for future in futures:
+                future.result()
+
+    def _delete_objects(self, objects: list[dict]):
+        """Delete up to 1000 objects from the S3 bucket with one request."""
+        response = self._s3_client.delete_objects(Bucket=self._bucketname,
+                                                  Delete={"Objects": objects, "Quiet": True})
+        errors = response.get("Errors")
+        if errors:
+            raise RuntimeError(f"Could not delete {len(errors)} objects from S3, for example: "
+                               f"{errors[0]}")
+
+    def _extract_content(self, filename: str, upload: bool = False, prefix: str = "data/"):
         """Extract content from the archive.  May also upload to S3.
 
+        The members are streamed from the archive to S3 without writing them to disk.  Large members
+        are uploaded in multiple parts, so the memory use is bounded as well.  Archives which exceed
+        the configured limits raise ``UnsafeArchive`` before anything is uploaded.
+
         Parameters
         ----------
         filename : str
 
         upload : bool, default=False
+
+        prefix : str, default="data/"
+          Key prefix for the uploaded files.
         """
-        with TemporaryDirectory() as tmp:
-            if not tmp.endswith(os.path.sep):
-                tmp = tmp + os.path.sep
-            zipf = ZipFile(filename)
-            zipf.extractall(path=tmp)  # TODO Zip bomb detection and prevention.
-            for name in zipf.namelist():
-                if name.endswith(".json") or name.endswith(os.path.sep):
+        with SafeArchive(filename, self._archive_limits) as archive, \
+                ThreadPoolExecutor(self._upload_workers) as executor:
+            futures = []
+            for info in archive.members:
+                if not is_data_member(info.filename):
                     continue
                 if upload:
-                    self._upload(os.path.join(tmp, name), remove_prefix=tmp)
-
-    def _upload(self, filename: str, remove_prefix: Optional[str] = None):
+                    futures.append(executor.submit(self._upload_member, archive, info, prefix))
+            for future in futures:
+                future.result()
+
+    def _upload_member(self, archive: SafeArchive, info: ZipInfo, prefix: str):
+        """Stream a single archive member to S3 and record the upload statistics."""
+        key = prefix + info.filename
+        start = time.monotonic()
+        with archive.open(info) as member:
+            self._s3_client.upload_fileobj(member, self._bucketname, key,
+                                           Config=self._transfer_config)
+        self._record_upload(key, info.file_size, time.monotonic() - start)
+
+    def _record_upload(self, key: str, size: int, duration: float):
+        """Store and print the statistics of an upload."""
+        self.upload_stats.append((key, size, duration))
+        metrics.BYTES_TRANSFERRED.inc(size, transfer="s3_upload")
+        throughput = size / duration / 1024**2 if duration > 0 else float("inf")
+        print(f"Uploaded {key}: {size} bytes in {duration:.2f} s ({throughput:.2f} MiB/s)")
+
+    def _upload(self, filename: str, remove_prefix: Optional[str] = None, prefix: str = "data/"):
         """Upload the file to the S3 bucket.
 
 Compressed files (with suffix .zip or .eln) will be extracted first.
@@ -172,43 +682,52 @@ filename : str
 
 remove_prefix : Optional[str]
   If given, remove this prefix from the filename when storing into the bucket.
-        """
-        # Check file type first.
-        if Path(filename).suffix in [".eln", ".zip"]:
-            self._extract_content(filename, upload=True)
-            return
 
-        target_filename = filename
-        if remove_prefix:
-            if not filename.startswith(remove_prefix):
-                raise ValueError(f"{filename} was expected to start with {remove_prefix}")
-            target_filename = filename[len(remove_prefix):]
-        self._s3_client.upload_file(filename, self._bucketname,
-                                    os.path.join("data", target_filename))
-
-    def _trigger_check(self) -> str:
+prefix : str, default="data/"
+  Key prefix for the uploaded files.
+        """
+        with metrics.stage("s3_staging"):
+            # Check file type first.
+            if Path(filename).suffix in [".eln", ".zip"]:
+                self._extract_content(filename, upload=True, prefix=prefix)
+                return
+
+            target_filename = filename
+            if remove_prefix:
+                if not filename.startswith(remove_prefix):
+                    raise ValueError(f"{filename} was expected to start with {remove_prefix}")
+                target_filename = filename[len(remove_prefix):]
+            key = prefix + target_filename.lstrip("/")
+            start = time.monotonic()
+            self._s3_client.upload_file(filename, self._bucketname, key,
+                                        Config=self._transfer_config)
+            self._record_upload(key, os.path.getsize(filename), time.monotonic() - start)
+
+    def _trigger_check(self, prefix: str = "data/") -> str:
         """Trigger a new pipeline to start quality checks.
 
+    Parameters
+    ----------
+    prefix : str, default="data/"
+      The S3 key prefix of the data to be checked, passed as ``RUQAD_S3_PREFIX`` variable.
+
     Returns
     -------
 
     out: str
       The ID of the started pipeline.
         """
-        cmd = ["curl",
-               "-X", "POST",
-               "--fail",
-               "-F", f"token={self._config['gitlab_pipeline_token']}",
-               "-F", "ref=ruqad",
-               "https://gitlab.indiscale.com/api/v4/projects/268/trigger/pipeline"
-               ]
-        cmd_result = run(cmd, check=False, capture_output=True)
-        result = json.loads(cmd_result.stdout)
+        with tracing.span("pipeline_trigger", prefix=prefix):
+            result = self._gitlab.trigger_pipeline(token=self._config['gitlab_pipeline_token'],
+                                                   ref="ruqad",
+                                                   variables={"RUQAD_S3_PREFIX": prefix})
         return str(result["id"])
 
     def _wait_for_check(self, pipeline_id: str) -> str:
         """Wait for the pipeline to finish successfully.
 
+The pipeline status is polled by the watcher which is shared with the other checks.
+
     Parameters
     ----------
     pipeline_id : str
@@ -220,21 +739,39 @@ remove_prefix : Optional[str]
       The ID of the "report" job.  FIXME: or "pages"?
         """
         # Wait for pipeline to finish.
-        cmd = [
-            "curl",
-            "--header", f"PRIVATE-TOKEN: {self._config['gitlab_api_token']}",
-            f"https://gitlab.indiscale.com/api/v4/projects/268/pipelines/{pipeline_id}"
-        ]
-        while True:
-            cmd_result = run(cmd, check=True, capture_output=True)
-            result = json.loads(cmd_result.stdout)
-            if "error" in result:
-                print("Pipeline terminated unsuccessfully: ", result["error_description"])
-                result["status"] = result["error_description"]
-                raise self.CheckFailed(result)
-            if result["status"] != "running" and result["finished_at"] is not None:
-                break
-            time.sleep(1)
+        timeout = self._config.get("gitlab_pipeline_timeout", 7200)
+        with metrics.stage("pipeline_wait"):
+            future = self._watcher.watch(pipeline_id)
+            try:
+                result = future.result(timeout=timeout)
+            except FutureTimeoutError as exc:
+                future.cancel()
+                raise TimeoutError(
+                    f"Pipeline {pipeline_id} did not finish within {timeout} s.") from exc
+            return self._report_job_id(pipeline_id, result)
+
+    async def _wait_for_check_async(self, pipeline_id: str) -> str:
+        """Like ``_wait_for_check``, but awaits the pipeline without blocking a thread."""
+        timeout = self._config.get("gitlab_pipeline_timeout", 7200)
+        with metrics.stage("pipeline_wait"):
+            try:
+                # Cancelling the wrapper on timeout also cancels the watcher's future.
+                result = await asyncio.wait_for(
+                    asyncio.wrap_future(self._watcher.watch(pipeline_id)), timeout)
+            except asyncio.TimeoutError as exc:
+                raise TimeoutError(
+                    f"Pipeline {pipeline_id} did not finish within {timeout} s.") from exc
+            return await asyncio.to_thread(self._report_job_id, pipeline_id, result)
+
+    def _report_job_id(self, pipeline_id: str, result: dict) -> str:
+        """Return the ID of the "report" job of the finished pipeline.
+
+Raises CheckFailed if the pipeline or its "evaluate" job did not succeed.
+        """
+        if "error" in result:
+            print("Pipeline terminated unsuccessfully: ", result["error_description"])
+            result["status"] = result["error_description"]
+            raise self.CheckFailed(result)
         if not result["status"] == "success":
             print("Pipeline terminated unsuccessfully.")
             raise self.CheckFailed(result)
@@ -244,13 +781,7 @@ remove_prefix : Optional[str]
         # - evaluate: run the quality check
         # - report: build the report
         # - pages: publish the report (not relevant for us)
-        cmd = [
-            "curl",
-            "--header", f"PRIVATE-TOKEN: {self._config['gitlab_api_token']}",
-            f"https://gitlab.indiscale.com/api/v4/projects/268/pipelines/{pipeline_id}/jobs"
-        ]
-        cmd_result = run(cmd, check=False, capture_output=True)
-        result = json.loads(cmd_result.stdout)
+        result = self._gitlab.get_pipeline_jobs(pipeline_id)
         evaluate_job = [job for job in result if job["name"] == "evaluate"][0]
         if not evaluate_job["status"] == "success":
             raise self.CheckFailed(result)
@@ -260,6 +791,10 @@ remove_prefix : Optional[str]
     def _download_result(self, job_id: str, target_dir: str = "."):
         """Download the artifacts from the pipeline.
 
+The archive is only stored as ``artifacts.zip`` once it is complete and intact.  The members
+listed in the config key ``result_extract_members`` (matched by file name, for example
+``qc_summary.json``) are additionally extracted into ``target_dir``.
+
     Parameters
     ----------
     job_id : str
@@ -269,16 +804,28 @@ remove_prefix : Optional[str]
       Download to this directory.
         """
         target = os.path.join(target_dir, "artifacts.zip")
-        cmd = [
-            "curl",
-            "--location", "--fail",
-            "--output", target,
-            "--header", f"PRIVATE-TOKEN: {self._config['gitlab_api_token']}",
-            f"https://gitlab.indiscale.com/api/v4/projects/268/jobs/{job_id}/artifacts"
-        ]
-        cmd_result = run(cmd, check=False, capture_output=True)
-        assert cmd_result.returncode == 0
+        with metrics.stage("artifact_download"):
+            self._gitlab.download_artifacts(job_id, target, limits=self._archive_limits)
+        metrics.BYTES_TRANSFERRED.inc(os.path.getsize(target), transfer="artifact_download")
         print(f"Downloaded archive to: {target}")
+        self._extract_result_members(target_dir)
+
+    def _extract_result_members(self, target_dir: str):
+        """Extract the members listed in ``result_extract_members`` from ``artifacts.zip``.
+
+The archive is checked against the archive limits first, and the members are read no further than
+their checked size.
+        """
+        extract = set(self._config.get("result_extract_members", []))
+        if extract:
+            with SafeArchive(os.path.join(target_dir, "artifacts.zip"),
+                             self._archive_limits) as archive:
+                for info in archive.members:
+                    name = os.path.basename(info.filename)
+                    if name in extract and not info.is_dir():
+                        with archive.open(info) as member, \
+                                open(os.path.join(target_dir, name), "wb") as fileobj:
+                            shutil.copyfileobj(member, fileobj)
 
 
 def _parse_arguments():
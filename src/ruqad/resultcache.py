@@ -0,0 +1,158 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Local cache of quality check results, addressed by the content of the checked data.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Optional
+
+from ruqad.archive import ArchiveLimits, SafeArchive
+
+CHUNK_SIZE = 1024**2
+
+
+def is_data_member(filename: str) -> bool:
+    """Return True if the archive member with this name is checked, i.e. is not metadata."""
+    return not filename.endswith(".json") and not filename.endswith("/")
+
+
+def content_key(filename: str, version: str, limits: Optional[ArchiveLimits] = None) -> str:
+    """Return a hash of the checked content of the file and the checker version.
+
+For ``.eln`` and ``.zip`` archives, only the names and contents of the data members are hashed, so
+re-exports of the same data with different metadata have the same key.
+
+Parameters
+----------
+filename : str
+  The file to be checked.
+
+version : str
+  The version of the checker.  Results of other versions are not reused.
+
+limits : Optional[ArchiveLimits]
+  Archives exceeding these limits are rejected with UnsafeArchive before anything is read.
+
+Returns
+-------
+out : str
+  The SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(version.encode() + b"\0")
+    if Path(filename).suffix in [".eln", ".zip"]:
+        with SafeArchive(filename, limits) as archive:
+            for info in sorted(archive.members, key=lambda info: info.filename):
+                if not is_data_member(info.filename):
+                    continue
+                digest.update(info.filename.encode() + b"\0")
+                digest.update(str(info.file_size).encode() + b"\0")
+                with archive.open(info) as member:
+                    while chunk := member.read(CHUNK_SIZE):
+                        digest.update(chunk)
+    else:
+        digest.update(Path(filename).name.encode() + b"\0")
+        with open(filename, "rb") as fileobj:
+            while chunk := fileobj.read(CHUNK_SIZE):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Directory with the result archives of successful quality checks.
+
+Each result is stored as ``<key>.zip``.  Entries which were not used for longer than ``max_age``
+are removed, and the least recently used entries are removed while the cache is larger than
+``max_size``.
+    """
+
+    def __init__(self, directory: str, max_size: int = 1024**3, max_age: float = 30 * 86400):
+        """
+Parameters
+----------
+directory : str
+  The cache directory.  It is created if it does not exist.
+
+max_size : int, default=1 GiB
+  The maximum total size of the cached results in bytes.
+
+max_age : float, default=30 days
+  The maximum time in seconds since an entry was last used.
+        """
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._max_age = max_age
+
+    def _path(self, key: str) -> Path:
+        return self._directory / f"{key}.zip"
+
+    def get(self, key: str, target: str) -> bool:
+        """Copy the cached result to ``target``.
+
+Returns
+-------
+out : bool
+  True if there was a result for this key, False otherwise.
+        """
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self._max_age:
+                path.unlink(missing_ok=True)
+                return False
+            shutil.copyfile(path, target)
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key: str, source: str):
+        """Store a copy of the result ``source`` under ``key`` and evict old entries."""
+        with NamedTemporaryFile(dir=self._directory, suffix=".tmp", delete=False) as tmp:
+            with open(source, "rb") as fileobj:
+                shutil.copyfileobj(fileobj, tmp)
+        os.replace(tmp.name, self._path(key))
+        self.evict()
+
+    def evict(self, now: Optional[float] = None):
+        """Remove entries which are too old, then the least recently used ones above the size."""
+        if now is None:
+            now = time.time()
+        entries = []
+        for path in self._directory.glob("*.zip"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self._max_age:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,130 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Durable state of the monitor, so that it can resume after a restart.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Optional
+
+
+class MonitorState:
+    """The cut off date and the processing status of each record, stored in an SQLite database.
+
+    The status of a record is one of ``STATUSES``.  It can be updated from several threads.  The
+    number of failed attempts is counted for each record, so that failed records can be retried a
+    limited number of times.
+    """
+
+    STATUSES = ("downloaded", "checked", "crawled", "failed")
+
+    def __init__(self, filename: str = ":memory:"):
+        """
+        Parameters
+        ----------
+        filename : str, default=":memory:"
+          The SQLite database file.  It is created if it does not exist.  By default, the state
+          is only kept in memory.
+        """
+        self._lock = Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id INTEGER PRIMARY KEY, status TEXT NOT NULL, updated_at TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(records)")]
+            if "attempts" not in columns:  # State files of older versions
+                self._connection.execute(
+                    "ALTER TABLE records ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
+
+    def get_cut_off_date(self) -> Optional[datetime]:
+        """Return the stored cut off date, or None if there is none yet."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM settings WHERE key = 'cut_off_date'").fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0])
+
+    def set_cut_off_date(self, cut_off_date: datetime):
+        """Store the cut off date."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('cut_off_date', ?)",
+                (cut_off_date.isoformat(),))
+
+    def get_status(self, rid: int) -> Optional[str]:
+        """Return the status of the record, or None if it is unknown."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status FROM records WHERE id = ?", (rid,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_status(self, rid: int, status: str):
+        """Store the status of the record.  Setting it to "failed" counts a failed attempt."""
+        if status not in self.STATUSES:
+            raise ValueError(f"Unknown status: {status}")
+        failed = int(status == "failed")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO records (id, status, updated_at, attempts) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET status = excluded.status, "
+                "updated_at = excluded.updated_at, attempts = attempts + excluded.attempts",
+                (rid, status, datetime.now(timezone.utc).isoformat(), failed))
+
+    def get_attempts(self, rid: int) -> int:
+        """Return how often processing the record failed."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT attempts FROM records WHERE id = ?", (rid,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def records_with_status(self, status: str, max_attempts: Optional[int] = None) -> list[int]:
+        """Return the IDs of the records with the given status, in ascending order.
+
+        Parameters
+        ----------
+        status : str
+          One of ``STATUSES``.
+
+        max_attempts : int, optional
+          If given, only records which failed less often than this are returned.
+        """
+        query = "SELECT id FROM records WHERE status = ?"
+        parameters: tuple = (status,)
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            parameters += (max_attempts,)
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY id", parameters).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,228 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Tracing of the processing of single records.
+
+``trace(record_id)`` opens a trace for a record, and ``span(name)`` opens a nested span within the
+trace of the current thread or task.  When a trace is finished, it is appended to the file given
+to ``configure``, either in the Chrome trace event format (for ``chrome://tracing`` or Perfetto)
+or as OTLP JSON, one ``ExportTraceServiceRequest`` per line.
+
+Until ``configure`` is called, tracing is disabled and ``trace`` and ``span`` return a shared no-op
+context manager.  Spans outside of a trace are no-ops as well.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import secrets
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+from threading import Lock
+from typing import Any, Optional
+
+FORMATS = ("chrome", "otlp")
+
+_NOOP = nullcontext()
+
+# The trace of the current thread or task and the ID of the innermost open span.
+_current: ContextVar[Optional[tuple[_Trace, Optional[str]]]] = ContextVar("ruqad_trace",
+                                                                          default=None)
+_exporter: Optional[_Exporter] = None
+
+
+class _Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: dict[str, Any]):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = self.start_ns
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+
+class _Trace:
+    def __init__(self, record_id):
+        self.trace_id = secrets.token_hex(16)
+        self.record_id = record_id
+        self.spans: list[_Span] = []
+        self._lock = Lock()
+
+    def add(self, span: _Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class _SpanContext:
+    """Context manager for an open span."""
+
+    def __init__(self, trace_: _Trace, parent_id: Optional[str], name: str,
+                 attributes: dict[str, Any]):
+        self._trace = trace_
+        self._parent_id = parent_id
+        self._name = name
+        self._attributes = attributes
+
+    def __enter__(self):
+        self._span = _Span(self._name, self._parent_id, self._attributes)
+        self._token = _current.set((self._trace, self._span.span_id))
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._span.end_ns = time.time_ns()
+        if exc is not None:
+            self._span.error = f"{exc_type.__name__}: {exc}"
+        _current.reset(self._token)
+        self._trace.add(self._span)
+
+
+class _TraceContext:
+    """Context manager for a new trace with its root span.  It is exported when it is closed."""
+
+    def __init__(self, record_id, attributes: dict[str, Any]):
+        self._trace = _Trace(record_id)
+        self._root = _SpanContext(self._trace, None, "record",
+                                  {"record_id": record_id, **attributes})
+
+    def __enter__(self):
+        self._root.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._root.__exit__(exc_type, exc, tb)
+        if _exporter is not None:
+            _exporter.export(self._trace)
+
+
+def trace(record_id, **attributes):
+    """Open a trace for the processing of the record ``record_id``.
+
+Parameters
+----------
+record_id
+  The ID of the record, stored as attribute of the root span.
+
+**attributes
+  Further attributes of the root span.
+    """
+    if _exporter is None:
+        return _NOOP
+    return _TraceContext(record_id, attributes)
+
+
+def span(name: str, **attributes):
+    """Open a span with the given name and attributes in the current trace, if there is one."""
+    current = _current.get()
+    if current is None:
+        return _NOOP
+    return _SpanContext(current[0], current[1], name, attributes)
+
+
+class _Exporter:
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._lock = Lock()
+
+    def export(self, trace_: _Trace):
+        text = self._format(trace_)
+        with self._lock, open(self._filename, "a", encoding="utf-8") as fileobj:
+            if fileobj.tell() == 0:
+                fileobj.write(self._header())
+            fileobj.write(text)
+
+    def _header(self) -> str:
+        return ""
+
+    def _format(self, trace_: _Trace) -> str:
+        raise NotImplementedError
+
+
+def _thread_id(record_id) -> int:
+    """The record ID as Chrome trace thread ID, so that each record is shown in its own row."""
+    try:
+        return int(record_id)
+    except (TypeError, ValueError):
+        return 0
+
+
+class _ChromeExporter(_Exporter):
+    """Complete events of the JSON array format.  The closing bracket is optional in this format, so
+    the file can be appended to and read at any time."""
+
+    def _header(self) -> str:
+        return "[\n"
+
+    def _format(self, trace_: _Trace) -> str:
+        events = []
+        for span_ in trace_.spans:
+            args = {key: str(value) for key, value in span_.attributes.items()}
+            if span_.error is not None:
+                args["error"] = span_.error
+            events.append(json.dumps({
+                "name": span_.name, "cat": "ruqad", "ph": "X",
+                "ts": span_.start_ns / 1000, "dur": (span_.end_ns - span_.start_ns) / 1000,
+                "pid": os.getpid(), "tid": _thread_id(trace_.record_id), "args": args,
+            }))
+        return "".join(event + ",\n" for event in events)
+
+
+class _OTLPExporter(_Exporter):
+    """One OTLP/JSON ``ExportTraceServiceRequest`` per line, like the file exporter of the
+    OpenTelemetry collector writes it."""
+
+    @staticmethod
+    def _attributes(attributes: dict[str, Any]) -> list[dict]:
+        return [{"key": key, "value": {"stringValue": str(value)}}
+                for key, value in attributes.items()]
+
+    def _format(self, trace_: _Trace) -> str:
+        spans = []
+        for span_ in trace_.spans:
+            otlp_span = {
+                "traceId": trace_.trace_id, "spanId": span_.span_id, "name": span_.name,
+                "kind": 1, "startTimeUnixNano": str(span_.start_ns),
+                "endTimeUnixNano": str(span_.end_ns),
+                "attributes": self._attributes(span_.attributes),
+                "status": {"code": 1},
+            }
+            if span_.parent_id is not None:
+                otlp_span["parentSpanId"] = span_.parent_id
+            if span_.error is not None:
+                otlp_span["status"] = {"code": 2, "message": span_.error}
+            spans.append(otlp_span)
+        request = {"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": "ruqad"})},
+            "scopeSpans": [{"scope": {"name": "ruqad"}, "spans": spans}],
+        }]}
+        return json.dumps(request) + "\n"
+
+
+def configure(filename: Optional[str], fmt: str = "chrome"):
+    """Enable tracing to ``filename`` in the format ``fmt`` ("chrome" or "otlp"), or disable it if
+    ``filename`` is None."""
+    global _exporter  # pylint: disable=global-statement
+    if filename is None:
+        _exporter = None
+        return
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown trace format {fmt}, expected one of {FORMATS}")
+    _exporter = _ChromeExporter(filename) if fmt == "chrome" else _OTLPExporter(filename)
@@ -0,0 +1,209 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+"""Receiver for notifications about created or updated Kadi records.
+
+A webhook, or a bridge from a message queue, sends a POST request with a JSON body to
+``http://<host>:<port>/events``::
+
+  {"event": "record.created", "record_id": 42}
+
+The body may also be a list of such objects.  ``event`` is optional and defaults to
+``record.created``.  If a token is configured, it must be sent in the ``X-Ruqad-Token`` header.
+The record IDs are collected in a ``RecordQueue`` from which ``rq_monitor`` takes them.
+"""
+
+from __future__ import annotations
+
+import hmac
+import ipaddress
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Thread
+from typing import Optional
+from urllib.request import Request, urlopen
+
+from ruqad import metrics
+
+EVENTS = ("record.created", "record.updated")
+
+TOKEN_HEADER = "X-Ruqad-Token"
+
+# Larger request bodies are rejected.
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class RecordQueue:
+    """Record IDs from notifications, with the event of each.
+
+    A record which is notified several times before it is taken is only queued once.  An update
+    takes precedence over a creation, so that records which were crawled already are processed
+    again.
+    """
+
+    def __init__(self):
+        self._cond = Condition()
+        self._events: dict[int, str] = {}
+
+    def put(self, rid: int, event: str = "record.created"):
+        with self._cond:
+            if self._events.get(rid) != "record.updated":
+                self._events[rid] = event
+            self._cond.notify_all()
+
+    def take(self, timeout: Optional[float] = None) -> dict[int, str]:
+        """Wait up to ``timeout`` seconds for notifications and take all queued records.
+
+Returns
+-------
+out : dict[int, str]
+  The event of each queued record ID, empty if there was no notification until the timeout.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._events, timeout=timeout)
+            events, self._events = self._events, {}
+        return events
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._events)
+
+
+def _parse_events(body: bytes) -> list[tuple[int, str]]:
+    """Return the record IDs and events of a request body.  Raises ValueError if it is invalid."""
+    data = json.loads(body)
+    items = data if isinstance(data, list) else [data]
+    events = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError(f"Expected an object, got {item!r}")
+        event = item.get("event", "record.created")
+        if event not in EVENTS:
+            raise ValueError(f"Unknown event {event!r}, expected one of {EVENTS}")
+        rid = item.get("record_id")
+        if isinstance(rid, bool) or not isinstance(rid, int):
+            raise ValueError(f"Expected an integer record_id, got {rid!r}")
+        events.append((rid, event))
+    return events
+
+
+def _handler(queue: RecordQueue, token: Optional[str]) -> type[BaseHTTPRequestHandler]:
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, data: dict, status: int):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.split("?")[0] != "/events":
+                self._send_json({"error": "not found"}, 404)
+                return
+            if token is not None and not hmac.compare_digest(
+                    self.headers.get(TOKEN_HEADER, "").encode(), token.encode()):
+                self._send_json({"error": "invalid token"}, 401)
+                return
+            length_header = self.headers.get("Content-Length")
+            if length_header is None:
+                self._send_json({"error": "Content-Length required"}, 411)
+                return
+            try:
+                length = int(length_header)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self._send_json({"error": "invalid Content-Length"}, 400)
+                return
+            if length > MAX_BODY_SIZE:
+                self._send_json({"error": "body too large"}, 413)
+                return
+            try:
+                events = _parse_events(self.rfile.read(length))
+            except ValueError as e:  # json.JSONDecodeError is a ValueError as well
+                self._send_json({"error": str(e)}, 400)
+                return
+            for rid, event in events:
+                queue.put(rid, event)
+                metrics.WEBHOOK_EVENTS.inc(event=event)
+            self._send_json({"queued": [rid for rid, _ in events]}, 202)
+
+    return WebhookHandler
+
+
+def _is_loopback(addr: str) -> bool:
+    """Whether ``addr`` is only reachable from the local host."""
+    if addr == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(addr).is_loopback
+    except ValueError:
+        return False
+
+
+def start_webhook_receiver(queue: RecordQueue, port: int, addr: str = "127.0.0.1",
+                           token: Optional[str] = None) -> ThreadingHTTPServer:
+    """Receive notifications at ``http://<addr>:<port>/events`` from a background thread.
+
+Every notification makes the monitor download and check a record, so a receiver which is
+reachable from other hosts must require a token.
+
+Parameters
+----------
+queue : RecordQueue
+  The notified records are put into this queue.
+
+port : int
+  The port to listen on, 0 for any free port.
+
+addr : str, default="127.0.0.1"
+  The address to listen on, by default only the local host.  Use ``""`` for all addresses.
+
+token : str, optional
+  If given, requests must send this token in the ``X-Ruqad-Token`` header.  Required unless
+  ``addr`` is a loopback address.
+    """
+    if token is None and not _is_loopback(addr):
+        raise ValueError("A token is required to receive notifications on "
+                         f"{addr or 'all addresses'}")
+    server = ThreadingHTTPServer((addr, port), _handler(queue, token))
+    Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    return server
+
+
+def notify(url: str, record_id: int, event: str = "record.created", token: Optional[str] = None,
+           timeout: float = 10) -> list[int]:
+    """Send a notification to a receiver at ``url`` (ending in ``/events``).
+
+Returns
+-------
+out : list[int]
+  The record IDs which were queued by the receiver.
+    """
+    headers = {"Content-Type": "application/json"}
+    if token is not None:
+        headers[TOKEN_HEADER] = token
+    request = Request(url, data=json.dumps({"event": event, "record_id": record_id}).encode(),
+                      headers=headers, method="POST")
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())["queued"]
@@ -0,0 +1,76 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import stat
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+import pytest
+
+from ruqad.archive import ArchiveLimits, SafeArchive, UnsafeArchive, check_archive
+
+
+def _make_zip(path, members: dict) -> str:
+    with ZipFile(path, "w", compression=ZIP_DEFLATED) as zipf:
+        for name, data in members.items():
+            zipf.writestr(name, data)
+    return str(path)
+
+
+def test_safe_archive():
+    eln = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+           "1223" / "export.eln")
+    with SafeArchive(str(eln)) as archive:
+        assert len(archive.members) > 0
+        with archive.open(archive.members[0]) as member:
+            member.read()
+
+
+def test_limits(tmp_path):
+    bomb = _make_zip(tmp_path / "bomb.zip", {"zeros.bin": b"\0" * 10 * 1024**2})
+    with pytest.raises(UnsafeArchive, match="Compression ratio"):
+        check_archive(bomb)
+    check_archive(bomb, ArchiveLimits(max_ratio=10000))
+
+    many = _make_zip(tmp_path / "many.zip", {f"file{ii}.txt": "x" for ii in range(11)})
+    with pytest.raises(UnsafeArchive, match="Too many members"):
+        check_archive(many, ArchiveLimits(max_members=10))
+
+    large = _make_zip(tmp_path / "large.zip", {"a.txt": "x" * 600, "b.txt": "x" * 600})
+    with pytest.raises(UnsafeArchive, match="Uncompressed size"):
+        check_archive(large, ArchiveLimits(max_total_size=1000))
+
+    limits = ArchiveLimits.from_config({"archive_max_members": 3, "s3_bucket": "ruqad"})
+    assert limits.max_members == 3
+    assert limits.max_ratio == ArchiveLimits().max_ratio
+
+
+@pytest.mark.parametrize("name", ["../evil.txt", "/etc/evil", "export/../../evil.txt",
+                                  "..\\evil.txt", "C:/evil.txt"])
+def test_unsafe_names(tmp_path, name):
+    archive = _make_zip(tmp_path / "evil.zip", {name: "x"})
+    with pytest.raises(UnsafeArchive, match="Unsafe member name"):
+        check_archive(archive)
+
+
+def test_symlink(tmp_path):
+    info = ZipInfo("link")
+    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+    with ZipFile(tmp_path / "link.zip", "w") as zipf:
+        zipf.writestr(info, "/etc/passwd")
+    with pytest.raises(UnsafeArchive, match="Symbolic link"):
+        check_archive(str(tmp_path / "link.zip"))
@@ -0,0 +1,206 @@
+# Copyright (C) 2024 IndiScale GmbH <info@indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for the crawler wrapper."""
+
+import io
+import pickle
+import shutil
+from hashlib import sha512
+from pathlib import Path
+from unittest.mock import patch, Mock
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import linkahead as db
+import pytest
+
+from ruqad import crawler
+from ruqad.archive import ArchiveLimits, UnsafeArchive
+
+EXAMPLE_DATA = Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad"
+
+
+def _scanned_entities() -> list[db.Entity]:
+    """Entities like they are returned by ``scan_directory``."""
+    eln_file = db.File(path="/data/ruqad/1/export.eln", file="/tmp/data/ruqad/1/export.eln")
+    eln_file.add_parent("ELNFile")
+    qc = db.Record()
+    qc.add_parent("QualityCheck")
+    qc.add_property("ELNFile", value=eln_file)
+    qc.add_property("FAIRLicenseCheck", value=True)
+    return [eln_file, qc]
+
+
+@patch("ruqad.crawler.crawler_main")
+@patch("ruqad.crawler._synchronize")
+@patch("ruqad.crawler.validate", new=Mock(return_value=[(True, None)]))
+@patch("ruqad.crawler.load_json_schema_from_datamodel_yaml", new=Mock(return_value={}))
+@patch("ruqad.crawler._settings_cache", new={})
+@patch("ruqad.crawler._scan")
+def test_single_scan(mock_scan, mock_sync, mock_crawler_main, tmp_path):
+    mock_scan.return_value = _scanned_entities()
+
+    retval, ent_qc = crawler.trigger_crawler(str(tmp_path), single_scan=True)
+
+    assert retval
+    assert len(ent_qc) == 1
+    mock_scan.assert_called_once()
+    mock_crawler_main.assert_not_called()
+    mock_sync.assert_called_once()
+    synced = mock_sync.call_args.args[0]
+    assert len(synced) == 2
+    # The returned records are not the ones which are synchronized.
+    assert synced[1] is not ent_qc[0]
+    assert ent_qc[0].get_property("ELNFile").value.path == "/data/ruqad/1/export.eln"
+
+
+@patch("linkahead.Container.update", autospec=True)
+@patch("linkahead.Container.insert", autospec=True)
+@patch("linkahead.execute_query")
+def test_register_files(mock_query, mock_insert, mock_update, tmp_path):
+    for rid in ("1", "2"):
+        (tmp_path / "ruqad" / rid).mkdir(parents=True)
+        (tmp_path / "ruqad" / rid / "export.eln").touch()
+    (tmp_path / "ruqad" / "1" / "report.zip").touch()
+    (tmp_path / "ruqad" / "1" / "ignored.txt").touch()
+    remote = db.File(id=101, path="/ruqad/1/export.eln")
+    remote.add_parent("ELNFile")
+    other = db.File(id=102, path="/ruqad/1/other.eln")
+    mock_query.side_effect = lambda query: (db.Container().extend([remote, other])
+                                            if "/ruqad/1/" in query else db.Container())
+
+    saved = crawler._register_files(str(tmp_path))
+
+    # 3 files: 6 requests one by one, 4 requests in bulk.
+    assert saved == 2
+    # Only the directories of the registered files are queried.
+    assert [call.args[0] for call in mock_query.call_args_list] == [
+        "FIND FILE WHICH IS STORED AT '/ruqad/1/*'", "FIND FILE WHICH IS STORED AT '/ruqad/2/*'"]
+    inserted = mock_insert.call_args.args[0]
+    assert sorted(f.path for f in inserted) == ["/ruqad/1/report.zip", "/ruqad/2/export.eln"]
+    updated = mock_update.call_args.args[0]
+    assert len(updated) == 1
+    assert updated[0] is remote
+    assert remote.file == str(tmp_path / "ruqad" / "1" / "export.eln")
+
+
+def test_file_unchanged(tmp_path):
+    local = tmp_path / "export.eln"
+    local.write_bytes(b"content")
+    remote = db.File(id=101, path="/ruqad/1/export.eln")
+    assert not crawler._file_unchanged(str(local), remote)  # no checksum known
+
+    remote._checksum = sha512(b"content").hexdigest().upper()
+    remote._size = "7"
+    assert crawler._file_unchanged(str(local), remote)
+
+    remote._size = "8"
+    assert not crawler._file_unchanged(str(local), remote)
+
+    remote._size = None
+    local.write_bytes(b"changed")
+    assert not crawler._file_unchanged(str(local), remote)
+
+
+@patch("ruqad.crawler._settings_cache", new={})
+def test_cached(tmp_path):
+    settings = tmp_path / "settings.yaml"
+    settings.write_text("a: 1\n")
+    loader = Mock(side_effect=lambda filename: Path(filename).read_text())
+
+    assert crawler._cached(settings, loader) == "a: 1\n"
+    assert crawler._cached(str(settings), loader) == "a: 1\n"
+    assert loader.call_count == 1
+
+    # Changed files are loaded again.
+    settings.write_text("a: 12\n")
+    assert crawler._cached(settings, loader) == "a: 12\n"
+    assert loader.call_count == 2
+
+
+def test_entity_pickler():
+    entities = _scanned_entities()
+    buffer = io.BytesIO()
+    crawler._EntityPickler(buffer).dump(entities)
+    eln_file, qc = pickle.loads(buffer.getvalue())
+
+    assert str(qc) == str(entities[1])
+    assert qc.get_property("ELNFile").value is eln_file
+    assert not qc.is_valid()
+    qc.add_property("numTotalChecks", value=20)
+    assert qc.get_property("numTotalChecks").value == 20
+
+
+def test_scan_parallel(tmp_path):
+    # The example exports, in more record directories than chunks per worker.
+    for ii, rid in enumerate(range(1, 10)):
+        source = EXAMPLE_DATA / ("1222", "1223")[ii % 2]
+        (tmp_path / "ruqad" / str(rid)).mkdir(parents=True)
+        for name in ("export.eln", "report.zip"):
+            shutil.copy(source / name, tmp_path / "ruqad" / str(rid) / name)
+    (tmp_path / "ruqad" / "not-a-directory.txt").touch()
+
+    try:
+        serial = crawler._scan(str(tmp_path))
+    except ValueError as e:
+        # The released rocrate package rejects the Kadi exports, the pinned crawler version is
+        # needed.
+        pytest.skip(f"Cannot scan the example exports: {e}")
+    parallel = crawler._scan_parallel(str(tmp_path), max_workers=2)
+
+    assert [str(ent) for ent in parallel] == [str(ent) for ent in serial]
+    qc_records = [ent for ent in parallel if ent.role == "Record"
+                  and ent.parents[0].name == "QualityCheck"]
+    assert len(qc_records) == 9
+    # References between the entities survive the transfer from the worker processes.
+    for qc in qc_records:
+        eln_file = qc.get_property("ELNFile").value
+        assert any(ent is eln_file for ent in parallel)
+        assert eln_file.parents[0].name == "ELNFile"
+
+
+def test_scan_parallel_reports(tmp_path):
+    """Like ``test_scan_parallel``, with quality check reports only, which need no RO-Crate."""
+    for rid in range(1, 10):
+        (tmp_path / "ruqad" / str(rid)).mkdir(parents=True)
+        shutil.copy(EXAMPLE_DATA / "1223" / "report.zip", tmp_path / "ruqad" / str(rid))
+    (tmp_path / "ruqad" / "not-a-directory.txt").touch()
+
+    serial = crawler._scan(str(tmp_path))
+    parallel = crawler._scan_parallel(str(tmp_path), max_workers=2)
+
+    assert [str(ent) for ent in parallel] == [str(ent) for ent in serial]
+    # The results of the chunks are in the order of the record directories.
+    assert [ent.path for ent in parallel if ent.role == "File"] == [
+        ent.path for ent in serial if ent.role == "File"]
+    qc_records = [ent for ent in parallel if ent.role == "Record"]
+    assert len(qc_records) == 9
+    for qc in qc_records:
+        assert qc.parents[0].name == "QualityCheck"
+        assert isinstance(qc.get_property("numTotalChecks").value, int)
+        for name in ("ELNFile", "QualityReportFile"):
+            assert any(ent is qc.get_property(name).value for ent in parallel)
+
+
+@patch("ruqad.crawler._register_files")
+def test_unsafe_archive(mock_register, tmp_path):
+    """Archives exceeding the limits are rejected before they are uploaded or unpacked."""
+    (tmp_path / "ruqad" / "1").mkdir(parents=True)
+    with ZipFile(tmp_path / "ruqad" / "1" / "export.eln", "w", compression=ZIP_DEFLATED) as zipf:
+        zipf.writestr("export/data.csv", "x" * 1000)
+    with pytest.raises(UnsafeArchive):
+        crawler.trigger_crawler(str(tmp_path), archive_limits=ArchiveLimits(max_total_size=100))
+    mock_register.assert_not_called()
@@ -15,7 +15,7 @@
 #
 from ruqad import kadi
 from datetime import datetime
-from unittest.mock import patch, Mock
+from unittest.mock import patch, MagicMock, Mock
 
 
 def mock_generator(manager):
@@ -44,3 +44,76 @@ def test_collect_records_created_after():
                                                         cut_off_date=datetime.fromisoformat(
                                                             "2024-01-01 03:00:00.000000+00:00")
                                                         )
+
+
+def test_generate_pages_lazily():
+    """Pages are only requested while they are needed."""
+    pages = [
+        {"items": [{"created_at": "2024-01-03 01:00:00.000000+00:00", "id": 1}],
+         "_pagination": {"total_pages": 3}},
+        {"items": [{"created_at": "2024-01-02 01:00:00.000000+00:00", "id": 2}],
+         "_pagination": {"total_pages": 3}},
+        {"items": [{"created_at": "2024-01-01 01:00:00.000000+00:00", "id": 3}],
+         "_pagination": {"total_pages": 3}},
+    ]
+    manager = Mock()
+    manager.search.search_resources.side_effect = (
+        lambda resource, **params: Mock(json=Mock(return_value=pages[params["page"] - 1])))
+
+    assert [1] == kadi.collect_records_created_after(
+        manager=manager,
+        cut_off_date=datetime.fromisoformat("2024-01-02 03:00:00.000000+00:00"))
+    assert manager.search.search_resources.call_count == 2
+
+    manager.search.search_resources.reset_mock()
+    assert [1, 2, 3] == kadi.collect_records_created_after(
+        manager=manager,
+        cut_off_date=datetime.fromisoformat("2023-01-01 03:00:00.000000+00:00"))
+    assert manager.search.search_resources.call_count == 3
+
+
+def _export_response(status_code: int, content: bytes = b"", headers: dict = None) -> MagicMock:
+    response = MagicMock(status_code=status_code, headers=headers or {},
+                         iter_content=Mock(return_value=[content]))
+    response.__enter__.return_value = response
+    return response
+
+
+@patch("ruqad.kadi.sleep")
+def test_download_elns_for(mock_sleep, tmp_path):
+    responses = {
+        "/records/1/export/ro-crate": [_export_response(200, b"one")],
+        # Server errors are retried.
+        "/records/2/export/ro-crate": [_export_response(503), _export_response(200, b"two")],
+        # Client errors are not.
+        "/records/3/export/ro-crate": [_export_response(404), _export_response(200, b"three")],
+        # Rate limiting is retried after the time given by the server.
+        "/records/4/export/ro-crate": [_export_response(429, headers={"Retry-After": "7"}),
+                                       _export_response(200, b"four")],
+    }
+    all_responses = [response for values in responses.values() for response in values]
+    manager = Mock()
+    manager.make_request.side_effect = lambda endpoint, **kwargs: responses[endpoint].pop(0)
+    paths = {rid: str(tmp_path / f"{rid}.eln") for rid in (1, 2, 3, 4)}
+
+    errors = kadi.download_elns_for(manager, paths, max_workers=4)
+
+    assert list(errors) == [3]
+    assert (tmp_path / "1.eln").read_bytes() == b"one"
+    assert (tmp_path / "2.eln").read_bytes() == b"two"
+    assert not (tmp_path / "3.eln").exists()
+    assert (tmp_path / "4.eln").read_bytes() == b"four"
+    assert sorted(call.args[0] for call in mock_sleep.call_args_list) == [1.0, 7.0]
+    # All requested responses are closed, also the failed ones.
+    used = [response for response in all_responses if response.__enter__.called]
+    assert len(used) == 6
+    assert all(response.__exit__.call_count == 1 for response in used)
+
+
+def test_retry_after():
+    assert kadi._retry_after(_export_response(429)) is None
+    assert kadi._retry_after(_export_response(429, headers={"Retry-After": "2.5"})) == 2.5
+    assert kadi._retry_after(_export_response(429, headers={"Retry-After": "100000"})) == 300
+    assert kadi._retry_after(
+        _export_response(429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+    assert kadi._retry_after(_export_response(429, headers={"Retry-After": "soon"})) is None
@@ -0,0 +1,62 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from urllib.request import urlopen
+
+import pytest
+
+from ruqad import metrics
+
+
+def test_histogram():
+    histogram = metrics.Histogram("test_duration_seconds", "A test histogram.", ("stage",),
+                                  buckets=(1, 10))
+    for value in (0.5, 1, 5, 100):
+        histogram.observe(value, stage="a")
+    assert histogram.count(stage="a") == 4
+    rendered = histogram.render()
+    assert "# TYPE test_duration_seconds histogram" in rendered
+    assert 'test_duration_seconds_bucket{stage="a",le="1.0"} 2' in rendered
+    assert 'test_duration_seconds_bucket{stage="a",le="10.0"} 3' in rendered
+    assert 'test_duration_seconds_bucket{stage="a",le="+Inf"} 4' in rendered
+    assert 'test_duration_seconds_sum{stage="a"} 106.5' in rendered
+    with pytest.raises(ValueError):
+        histogram.observe(1)
+
+
+def test_stage():
+    errors = metrics.ERRORS.value(stage="test_stage")
+    with metrics.stage("test_stage"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.stage("test_stage"):
+            raise RuntimeError("failed")
+    assert metrics.STAGE_DURATION.count(stage="test_stage") == 2
+    assert metrics.ERRORS.value(stage="test_stage") == errors + 1
+
+
+def test_metrics_server():
+    metrics.RECORDS_PROCESSED.inc(status="crawled")
+    server = metrics.start_metrics_server(0, addr="127.0.0.1")
+    try:
+        with urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert "# TYPE ruqad_records_processed_total counter" in body
+    assert 'ruqad_records_processed_total{status="crawled"}' in body
+    assert "# TYPE ruqad_stage_duration_seconds histogram" in body
@@ -0,0 +1,214 @@
+# Copyright (C) 2024 IndiScale GmbH <info@indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for the monitor."""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from contextlib import nullcontext
+from pathlib import Path
+from unittest.mock import patch, Mock
+
+os.environ.setdefault("KADIHOST", "http://localhost/kadi")
+os.environ.setdefault("KADITOKEN", "pat_1234")
+
+from ruqad import metrics, monitor  # noqa: E402
+from ruqad.state import MonitorState  # noqa: E402
+
+
+class _ConcurrencyCounter:
+    """Counts how many threads are in a stage at the same time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.maximum = 0
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.current += 1
+            self.maximum = max(self.maximum, self.current)
+        time.sleep(0.05)
+        with self._lock:
+            self.current -= 1
+
+
+def _fake_download(manager, rid, path):
+    Path(path).touch()
+
+
+def _fake_tempdir(tmp_path: Path):
+    """Replacement for ``TemporaryDirectory(delete=False)``, which needs Python 3.12."""
+    counter = iter(range(1000))
+
+    def tempdir(**kwargs):
+        cdir = tmp_path / str(next(counter))
+        cdir.mkdir()
+        return nullcontext(str(cdir))
+    return tempdir
+
+
+@patch("ruqad.monitor.SKIP_QUALITY_CHECK", new=False)
+@patch("ruqad.monitor.MONITOR_WORKERS", new=4)
+@patch("ruqad.monitor.trigger_crawler")
+@patch("ruqad.monitor.QualityChecker")
+@patch("ruqad.monitor.download_eln_for", new=Mock(side_effect=_fake_download))
+def test_process_records(mock_qc, mock_crawler, tmp_path):
+    checks = _ConcurrencyCounter()
+    mock_qc.return_value.check.side_effect = checks
+    mock_crawler.side_effect = [None, RuntimeError("crawler failed"), None, None]
+
+    crawled = metrics.RECORDS_PROCESSED.value(status="crawled")
+    download_errors = metrics.ERRORS.value(stage="kadi_download")
+    with patch("ruqad.monitor.TemporaryDirectory", new=_fake_tempdir(tmp_path)):
+        state = MonitorState()
+        failed = monitor._process_records(manager=None, rec_ids=[1, 2, 3, 4], state=state)
+
+    # A failing record does not stop the others.
+    assert len(failed) == 1
+    assert mock_crawler.call_count == 4
+    # Quality checks are limited to one at a time by default.
+    assert mock_qc.return_value.check.call_count == 4
+    assert checks.maximum == 1
+    assert [state.get_status(rid) for rid in failed] == ["failed"]
+    assert sorted(state.get_status(rid) for rid in [1, 2, 3, 4]) == ["crawled"] * 3 + ["failed"]
+    assert metrics.RECORDS_PROCESSED.value(status="crawled") == crawled + 3
+    assert metrics.ERRORS.value(stage="kadi_download") == download_errors
+
+
+@patch("ruqad.monitor.MONITOR_BATCH_SIZE", new=25)
+@patch("ruqad.monitor.sleep")
+@patch("ruqad.monitor._process_records")
+@patch("ruqad.monitor.collect_record_dates_created_after")
+def test_process_new_records(mock_collect, mock_process, mock_sleep):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    # Newest first, as returned by Kadi, including a record at the cut off date.
+    records = [(rid, start + timedelta(minutes=rid)) for rid in range(60, -1, -1)]
+    mock_collect.return_value = records
+
+    state = MonitorState()
+    cut_off_date = monitor._process_new_records(manager=None, cut_off_date=start, state=state)
+
+    assert cut_off_date == start + timedelta(minutes=60)
+    assert state.get_cut_off_date() == cut_off_date
+    batches = [call.args[1] for call in mock_process.call_args_list]
+    assert batches == [list(range(1, 26)), list(range(26, 51)), list(range(51, 61))]
+    assert mock_sleep.call_count == 2
+
+    # Nothing new: The cut off date stays the same.
+    mock_collect.return_value = [(60, start + timedelta(minutes=60))]
+    mock_process.reset_mock()
+    assert monitor._process_new_records(manager=None, cut_off_date=cut_off_date,
+                                        state=state) == cut_off_date
+    mock_process.assert_not_called()
+
+    # Records which were crawled already are skipped.
+    state.set_status(3, "crawled")
+    mock_process.reset_mock()
+    monitor._process_new_records(manager=None, cut_off_date=start, state=state)
+    assert 3 not in mock_process.call_args_list[0].args[1]
+
+
+@patch("ruqad.monitor.MONITOR_BATCH_SIZE", new=3)
+@patch("ruqad.monitor.sleep", new=Mock())
+@patch("ruqad.monitor.trigger_crawler")
+@patch("ruqad.monitor.download_eln_for", new=Mock(side_effect=_fake_download))
+@patch("ruqad.monitor.SKIP_QUALITY_CHECK", new=True)
+@patch("ruqad.monitor.collect_record_dates_created_after")
+def test_process_new_records_failed(mock_collect, mock_crawler, tmp_path):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    mock_collect.side_effect = lambda manager, cut_off_date: [
+        (rid, start + timedelta(minutes=rid)) for rid in range(6, 0, -1)
+        if start + timedelta(minutes=rid) > cut_off_date]
+    # Record 2 fails once.
+    failing = {2}
+    crawled = []
+
+    def crawl(target_dir):
+        rid = int(os.listdir(os.path.join(target_dir, "ruqad"))[0])
+        if rid in failing:
+            failing.remove(rid)
+            raise RuntimeError("crawler failed")
+        crawled.append(rid)
+    mock_crawler.side_effect = crawl
+
+    state = MonitorState()
+    with patch("ruqad.monitor.TemporaryDirectory", new=_fake_tempdir(tmp_path)):
+        cut_off_date = monitor._process_new_records(manager=None, cut_off_date=start,
+                                                    state=state)
+        # The other records are processed, but the cut off date stays before the failed one.
+        assert sorted(crawled) == [1, 3, 4, 5, 6]
+        assert state.get_status(2) == "failed"
+        assert cut_off_date < start + timedelta(minutes=2)
+        assert state.get_cut_off_date() == cut_off_date
+
+        # The next call retries it and skips the crawled records.
+        crawled.clear()
+        cut_off_date = monitor._process_new_records(manager=None, cut_off_date=cut_off_date,
+                                                    state=state)
+    assert crawled == [2]
+    assert state.get_status(2) == "crawled"
+    assert cut_off_date == start + timedelta(minutes=6)
+
+
+@patch("ruqad.monitor.MONITOR_MAX_ATTEMPTS", new=2)
+@patch("ruqad.monitor._process_records")
+@patch("ruqad.monitor.collect_record_dates_created_after")
+def test_retry_failed_records(mock_collect, mock_process):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    mock_collect.return_value = [(2, start + timedelta(minutes=2))]
+    state = MonitorState()
+
+    def process(manager, rec_ids, state):
+        for rid in rec_ids:
+            state.set_status(rid, "failed")
+        return rec_ids
+    mock_process.side_effect = process
+
+    # A notified record failed, e.g. before a restart.
+    state.set_status(1, "failed")
+    cut_off_date = monitor._process_new_records(manager=None, cut_off_date=start, state=state)
+    assert [call.args[1] for call in mock_process.call_args_list] == [[1], [2]]
+    assert cut_off_date < start + timedelta(minutes=2)
+
+    # After MONITOR_MAX_ATTEMPTS, the records are given up and the cut off date moves on.
+    mock_process.reset_mock()
+    cut_off_date = monitor._process_new_records(manager=None, cut_off_date=cut_off_date,
+                                                state=state)
+    assert [call.args[1] for call in mock_process.call_args_list] == [[2]]
+    assert cut_off_date == start + timedelta(minutes=2)
+
+    mock_process.reset_mock()
+    monitor._process_new_records(manager=None, cut_off_date=start, state=state)
+    mock_process.assert_not_called()
+
+
+@patch("ruqad.monitor._process_records")
+def test_process_notified_records(mock_process):
+    state = MonitorState()
+    state.set_status(1, "crawled")
+    state.set_status(2, "crawled")
+    for _ in range(monitor.MONITOR_MAX_ATTEMPTS):
+        state.set_status(4, "failed")
+    monitor._process_notified_records(
+        manager=None, events={1: "record.created", 2: "record.updated", 3: "record.created",
+                              4: "record.updated"},
+        state=state)
+    # Created records which were crawled already are skipped, updated ones are processed again,
+    # unless they failed too often.
+    assert sorted(mock_process.call_args.args[1]) == [2, 3]
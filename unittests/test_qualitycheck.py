@@ -16,11 +16,44 @@
 
 """Unit tests for the QualityChecker."""
 
+import asyncio
+import io
+import json
+import threading
+import time
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs
+from concurrent.futures import Future
 from unittest.mock import patch, Mock
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import pytest
+import requests
 
 from ruqad import qualitycheck
+from ruqad.archive import ArchiveLimits, UnsafeArchive
+
+
+@pytest.fixture(autouse=True)
+def qc_config(tmp_path_factory, monkeypatch):
+    """Run each test in a directory with its own ``qualitycheck_config.toml`` and secrets."""
+    config_dir = tmp_path_factory.mktemp("config")
+    (config_dir / "qualitycheck_config.toml").write_text(
+        's3_endpoint = "http://s3.invalid"\ns3_bucket = "ruqad"\n')
+    monkeypatch.chdir(config_dir)
+    for varname in ("S3_ACCESS_KEY_ID", "S3_SECRET_ACCESS_KEY", "GITLAB_PIPELINE_TOKEN",
+                    "GITLAB_API_TOKEN"):
+        monkeypatch.setenv(varname, "test")
+
+
+@pytest.fixture(autouse=True)
+def clear_s3_clients():
+    """The S3 clients are cached, but each test mocks them anew."""
+    qualitycheck._get_s3_client.cache_clear()
+    qualitycheck._get_gitlab_client.cache_clear()
+    qualitycheck._get_pipeline_watcher.cache_clear()
 
 
 @patch("boto3.Session.client")
@@ -31,13 +64,446 @@ def test_qc_internal(mock_s3_client):
     qc._extract_content(zipfile, upload=True)
     correct_call = False
     for call in mock_s3_client.mock_calls:
-        if not call[0] == '().upload_file':
+        if not call[0] == '().upload_fileobj':
             continue
         if (len(call.args) == 3
-            and call.args[0].endswith("abalone2.csv")
             and call.args[1] == "ruqad"
             and call.args[2] ==
                 "data/test-crawler-second/test-crawler-second/files/abalone2.csv"):
             correct_call = True
             break
     assert correct_call
+
+
+@patch("boto3.Session.client")
+def test_extract_content_streams(mock_s3_client):
+    """The archive members are uploaded from the archive, without extracting them to disk."""
+    zipfile = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+               "1223" / "export.eln")
+    uploaded = {}
+    mock_s3_client.return_value.upload_fileobj.side_effect = (
+        lambda fileobj, bucket, key, **kwargs: uploaded.update({key: fileobj.read()}))
+    qc = qualitycheck.QualityChecker()
+    qc._extract_content(zipfile, upload=True)
+
+    with ZipFile(zipfile) as zipf:
+        expected = {"data/" + name: zipf.read(name) for name in zipf.namelist()
+                    if not (name.endswith(".json") or name.endswith("/"))}
+    assert len(uploaded) > 0
+    assert uploaded == expected
+    assert sorted(key for key, _, _ in qc.upload_stats) == sorted(expected)
+
+
+@patch("boto3.Session.client")
+def test_cleanup(mock_s3_client):
+    keys = [f"data/file{ii}.csv" for ii in range(2005)]
+    pages = [{"Contents": [{"Key": key} for key in keys[start:start + 1000]]}
+             for start in range(0, len(keys), 1000)]
+    client = mock_s3_client.return_value
+    client.get_paginator.return_value.paginate.return_value = pages
+    client.delete_objects.return_value = {}
+
+    qc = qualitycheck.QualityChecker()
+    qc._cleanup(prefix="data/")
+
+    client.get_paginator.return_value.paginate.assert_called_once_with(Bucket="ruqad",
+                                                                       Prefix="data/")
+    assert client.delete_objects.call_count == 3
+    deleted = [obj["Key"] for call in client.delete_objects.call_args_list
+               for obj in call.kwargs["Delete"]["Objects"]]
+    assert sorted(deleted) == sorted(keys)
+
+    # Failed deletions are reported.
+    client.delete_objects.return_value = {"Errors": [{"Key": "data/file0.csv"}]}
+    with pytest.raises(RuntimeError):
+        qc._cleanup()
+
+
+@patch("boto3.Session.client")
+def test_check_prefix(mock_s3_client):
+    """Each check uses its own S3 key prefix, for the upload, the pipeline and the cleanup."""
+    zipfile = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+               "1223" / "export.eln")
+    client = mock_s3_client.return_value
+    client.get_paginator.return_value.paginate.return_value = []
+    qc = qualitycheck.QualityChecker()
+    qc._trigger_check = Mock(return_value="12")
+    qc._wait_for_check = Mock(return_value="34")
+    qc._download_result = Mock()
+
+    assert qc.check(filename=str(zipfile), record_id=1223)
+    assert qc.check(filename=str(zipfile), record_id=1223)
+
+    prefixes = [call.kwargs["prefix"] for call in qc._trigger_check.call_args_list]
+    assert prefixes[0] != prefixes[1]
+    for prefix in prefixes:
+        assert prefix.startswith("data/1223/")
+        assert prefix.endswith("/")
+    keys = [call.args[2] for call in client.upload_fileobj.call_args_list]
+    assert len(keys) > 0
+    assert all(key.startswith(prefixes[0]) or key.startswith(prefixes[1]) for key in keys)
+    cleaned = [call.kwargs["Prefix"]
+               for call in client.get_paginator.return_value.paginate.call_args_list]
+    assert cleaned == prefixes
+
+
+@patch("boto3.Session.client")
+def test_check_upload_failed(mock_s3_client):
+    """The data of a failed upload is cleaned up, as nothing else would ever remove it."""
+    zipfile = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+               "1223" / "export.eln")
+    client = mock_s3_client.return_value
+    client.get_paginator.return_value.paginate.return_value = []
+    qc = qualitycheck.QualityChecker()
+    qc._trigger_check = Mock()
+    upload_member = qc._upload_member
+
+    def failing_upload_member(archive, info, prefix):
+        if info.filename.endswith(".csv"):
+            raise OSError("upload failed")
+        upload_member(archive, info, prefix)
+    qc._upload_member = failing_upload_member
+    qc._new_prefix = Mock(side_effect=["data/1/a/", "data/1/b/"])
+
+    with pytest.raises(OSError):
+        qc.check(filename=str(zipfile), record_id=1)
+    with pytest.raises(OSError):
+        asyncio.run(qc.check_async(filename=str(zipfile), record_id=1))
+
+    qc._trigger_check.assert_not_called()
+    cleaned = [call.kwargs["Prefix"]
+               for call in client.get_paginator.return_value.paginate.call_args_list]
+    assert cleaned == ["data/1/a/", "data/1/b/"]
+
+
+def _artifacts_zip() -> bytes:
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w") as zipf:
+        zipf.writestr("public/qc_summary.json", '{"check_counts": {}}')
+        zipf.writestr("public/report.html", "<html></html>" * 1000)
+    return buffer.getvalue()
+
+
+class _GitlabStub(BaseHTTPRequestHandler):
+    """Answers like the GitLab API for a pipeline that first runs, then succeeds.
+
+    The first artifacts download breaks off in the middle, so that it must be resumed.
+    """
+
+    requests = []
+    polls = 0
+    artifacts = _artifacts_zip()
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, content_type: str = "application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        type(self).requests.append(("POST", self.path, parse_qs(self.rfile.read(length).decode())))
+        self._send(json.dumps({"id": 12}).encode())
+
+    def do_GET(self):
+        type(self).requests.append(("GET", self.path, self.headers["PRIVATE-TOKEN"]))
+        if self.path.endswith("/pipelines/12"):
+            type(self).polls += 1
+            status = "running" if self.polls < 2 else "success"
+            finished = None if self.polls < 2 else "2024-11-01T12:00:00Z"
+            self._send(json.dumps({"status": status, "finished_at": finished}).encode())
+        elif self.path.endswith("/pipelines/12/jobs"):
+            self._send(json.dumps([{"name": "evaluate", "status": "success", "id": 33},
+                                   {"name": "report", "status": "success", "id": 34}]).encode())
+        elif self.path.endswith("/jobs/34/artifacts"):
+            range_header = self.headers["Range"]
+            type(self).requests[-1] += (range_header,)
+            if range_header is None:
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(self.artifacts)))
+                self.end_headers()
+                self.wfile.write(self.artifacts[:len(self.artifacts) // 2])
+                self.close_connection = True
+            else:
+                offset = int(range_header.removeprefix("bytes=").rstrip("-"))
+                body = self.artifacts[offset:]
+                self.send_response(206)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+
+def test_gitlab_client(tmp_path):
+    """Trigger, poll and download go to the GitLab API over one session, without curl."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GitlabStub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        qc = qualitycheck.QualityChecker()
+        qc._config["gitlab_pipeline_token"] = "trigger-token"
+        qc._config["result_extract_members"] = ["qc_summary.json"]
+        qc._gitlab = qualitycheck.GitlabClient(f"http://127.0.0.1:{server.server_port}/api/v4",
+                                               268, "api-token", timeout=5)
+        qc._watcher = qualitycheck.PipelineWatcher(qc._gitlab, min_delay=0.01, max_delay=0.01,
+                                                   max_requests_per_second=1000)
+
+        pipeline_id = qc._trigger_check(prefix="data/1223/abc/")
+        assert pipeline_id == "12"
+        assert qc._wait_for_check(pipeline_id) == 34
+        qc._download_result(34, target_dir=str(tmp_path))
+        # Error responses, e.g. for unknown pipelines, raise instead of being returned.
+        with pytest.raises(requests.HTTPError):
+            qc._gitlab.get_pipeline("99")
+    finally:
+        server.shutdown()
+
+    assert (tmp_path / "artifacts.zip").read_bytes() == _GitlabStub.artifacts
+    ranges = [request[3] for request in _GitlabStub.requests if len(request) == 4]
+    assert ranges == [None, f"bytes={len(_GitlabStub.artifacts) // 2}-"]
+    assert (tmp_path / "qc_summary.json").read_text() == '{"check_counts": {}}'
+    assert not (tmp_path / "report.html").exists()
+    method, path, form = _GitlabStub.requests[0]
+    assert (method, path) == ("POST", "/api/v4/projects/268/trigger/pipeline")
+    assert form == {"token": ["trigger-token"], "ref": ["ruqad"],
+                    "variables[RUQAD_S3_PREFIX]": ["data/1223/abc/"]}
+    assert all(request[2] == "api-token" for request in _GitlabStub.requests[1:])
+    assert _GitlabStub.polls == 2
+
+
+def test_pipeline_watcher():
+    """One watcher polls several pipelines with backoff and within the request budget."""
+    polls = {"1": 0, "2": 0, "3": 0}
+    times = []
+
+    def get_pipeline(pipeline_id):
+        times.append(time.monotonic())
+        polls[pipeline_id] += 1
+        if pipeline_id == "3":
+            return {"error": "404 Not Found", "error_description": "404 Not Found"}
+        if polls[pipeline_id] < int(pipeline_id) + 2:
+            return {"status": "running", "finished_at": None}
+        return {"status": "success", "finished_at": "2024-11-01T12:00:00Z"}
+
+    gitlab = Mock()
+    gitlab.get_pipeline.side_effect = get_pipeline
+    watcher = qualitycheck.PipelineWatcher(gitlab, min_delay=0.01, max_delay=0.04,
+                                           max_requests_per_second=100)
+    futures = {pid: watcher.watch(pid) for pid in polls}
+
+    assert futures["1"].result(timeout=5)["status"] == "success"
+    assert futures["2"].result(timeout=5)["status"] == "success"
+    assert "error" in futures["3"].result(timeout=5)
+    assert polls == {"1": 3, "2": 4, "3": 1}
+    # The budget is shared by all pipelines.
+    intervals = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert min(intervals) >= 0.009
+    assert watcher.typical_duration is not None
+
+    # A new pipeline is first polled only when it will typically have finished.
+    polls["1"] = 0
+    typical = watcher.typical_duration
+    start = time.monotonic()
+    watcher.watch("1").result(timeout=5)
+    assert times[-3] - start >= min(0.8 * typical, 0.04)
+
+
+def test_pipeline_watcher_error():
+    """Failed status requests are passed on to the waiting caller."""
+    gitlab = Mock()
+    gitlab.get_pipeline.side_effect = ConnectionError("unreachable")
+    watcher = qualitycheck.PipelineWatcher(gitlab, min_delay=0.01)
+    with pytest.raises(ConnectionError):
+        watcher.watch("1").result(timeout=5)
+
+    # Unexpected responses fail only their own pipeline, the watcher keeps running.
+    gitlab.get_pipeline.side_effect = lambda pipeline_id: (
+        {"message": "401 Unauthorized"} if pipeline_id == "2"
+        else {"status": "success", "finished_at": "2024-11-01T12:00:00Z"})
+    failing, other = watcher.watch("2"), watcher.watch("3")
+    with pytest.raises(KeyError):
+        failing.result(timeout=5)
+    assert other.result(timeout=5)["status"] == "success"
+    assert watcher.watch("4").result(timeout=5)["status"] == "success"
+
+
+@patch("boto3.Session.client")
+def test_wait_for_check_timeout(mock_s3_client):
+    """Waiting for a pipeline which does not finish times out and stops watching it."""
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = []
+    qc = qualitycheck.QualityChecker()
+    qc._config["gitlab_pipeline_timeout"] = 0.1
+    gitlab = Mock()
+    gitlab.get_pipeline.return_value = {"status": "running", "finished_at": None}
+    qc._watcher = qualitycheck.PipelineWatcher(gitlab, min_delay=0.01, max_delay=0.01,
+                                               max_requests_per_second=1000)
+    qc._upload = Mock()
+    qc._trigger_check = Mock(return_value="12")
+    qc._cleanup = Mock()
+
+    with pytest.raises(TimeoutError):
+        qc.check(filename="export.eln", record_id=1)
+    # The S3 data is cleaned up nevertheless.
+    qc._cleanup.assert_called_once()
+    time.sleep(0.05)
+    polls = gitlab.get_pipeline.call_count
+    time.sleep(0.1)
+    assert gitlab.get_pipeline.call_count <= polls + 1
+
+    with pytest.raises(TimeoutError):
+        asyncio.run(qc._wait_for_check_async("13"))
+
+
+@patch("boto3.Session.client")
+def test_check_result_cache(mock_s3_client, tmp_path):
+    """Content which was checked successfully before is not checked again."""
+    zipfile = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+               "1223" / "export.eln")
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = []
+    qc = qualitycheck.QualityChecker()
+    qc._result_cache = qualitycheck.ResultCache(str(tmp_path / "cache"))
+    qc._trigger_check = Mock(return_value="12")
+    qc._wait_for_check = Mock(return_value="34")
+
+    def download_result(job_id, target_dir):
+        (Path(target_dir) / "artifacts.zip").write_bytes(b"report")
+    qc._download_result = Mock(side_effect=download_result)
+
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    assert qc.check(filename=str(zipfile), target_dir=str(first))
+    assert qc.check(filename=str(zipfile), target_dir=str(second))
+
+    assert qc._trigger_check.call_count == 1
+    assert (second / "artifacts.zip").read_bytes() == b"report"
+
+
+def test_download_artifacts_broken(tmp_path):
+    """An archive which is not a valid zip file is not stored."""
+    gitlab = qualitycheck.GitlabClient("http://gitlab.invalid/api/v4", 268, "api-token")
+
+    def download_part(path, part):
+        with open(part, "wb") as fileobj:
+            fileobj.write(b"no zip file")
+    gitlab._download_part = Mock(side_effect=download_part)
+    with pytest.raises(RuntimeError):
+        gitlab.download_artifacts("34", str(tmp_path / "artifacts.zip"), attempts=2)
+    assert gitlab._download_part.call_count == 2
+    assert list(tmp_path.iterdir()) == []
+
+    with pytest.raises(ValueError):
+        gitlab.download_artifacts("34", str(tmp_path / "artifacts.zip"), attempts=0)
+
+
+def test_download_artifacts_unsafe(tmp_path):
+    """Artifacts exceeding the archive limits are rejected before they are decompressed."""
+    gitlab = qualitycheck.GitlabClient("http://gitlab.invalid/api/v4", 268, "api-token")
+
+    def download_part(path, part):
+        with ZipFile(part, "w", compression=ZIP_DEFLATED) as zipf:
+            zipf.writestr("qc_summary.json", "x" * 1000)
+    gitlab._download_part = Mock(side_effect=download_part)
+    with pytest.raises(UnsafeArchive):
+        gitlab.download_artifacts("34", str(tmp_path / "artifacts.zip"),
+                                  limits=ArchiveLimits(max_total_size=100))
+    assert gitlab._download_part.call_count == 1
+    assert list(tmp_path.iterdir()) == []
+
+    # A member whose data does not match its CRC is detected.
+    def download_part_broken(path, part):
+        with ZipFile(part, "w") as zipf:
+            zipf.writestr("qc_summary.json", "{}")
+        with open(part, "r+b") as fileobj:
+            fileobj.seek(30 + len("qc_summary.json"))  # The data after the local header
+            fileobj.write(b"[")
+    gitlab._download_part = Mock(side_effect=download_part_broken)
+    with pytest.raises(RuntimeError):
+        gitlab.download_artifacts("34", str(tmp_path / "artifacts.zip"), attempts=1)
+
+
+@patch("boto3.Session.client")
+def test_extract_result_members_unsafe(mock_s3_client, tmp_path):
+    """The result members are only extracted from archives within the limits."""
+    with ZipFile(tmp_path / "artifacts.zip", "w", compression=ZIP_DEFLATED) as zipf:
+        zipf.writestr("qc_summary.json", "x" * 1000)
+    qc = qualitycheck.QualityChecker()
+    qc._config["result_extract_members"] = ["qc_summary.json"]
+    qc._archive_limits = ArchiveLimits(max_total_size=100)
+    with pytest.raises(UnsafeArchive):
+        qc._extract_result_members(str(tmp_path))
+    assert not (tmp_path / "qc_summary.json").exists()
+
+
+@patch("boto3.Session.client")
+def test_extract_content_unsafe(mock_s3_client, tmp_path):
+    """Nothing is uploaded from an archive which exceeds the limits."""
+    with ZipFile(tmp_path / "export.eln", "w") as zipf:
+        zipf.writestr("export/data.csv", "x" * 1000)
+        zipf.writestr("../evil.csv", "x")
+    qc = qualitycheck.QualityChecker()
+    with pytest.raises(UnsafeArchive):
+        qc._upload(str(tmp_path / "export.eln"), prefix="data/1/")
+    mock_s3_client.return_value.upload_fileobj.assert_not_called()
+
+
+class _TimedWatcher:
+    """Pipelines finish after ``duration`` seconds, those with "fail" in their ID unsuccessfully."""
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.finished = []
+
+    def watch(self, pipeline_id):
+        future = Future()
+
+        def finish():
+            self.finished.append(time.monotonic())
+            status = "failed" if "fail" in pipeline_id else "success"
+            future.set_result({"status": status, "finished_at": "2024-11-01T12:00:00Z"})
+        threading.Timer(self.duration, finish).start()
+        return future
+
+
+@patch("boto3.Session.client")
+def test_check_async(mock_s3_client):
+    """Concurrent async checks overlap the uploads of some records with the pipelines of others."""
+    zipfile = (Path(__file__).parents[1] / "end-to-end-tests" / "data" / "crawler_data" / "ruqad" /
+               "1223" / "export.eln")
+    mock_s3_client.return_value.get_paginator.return_value.paginate.return_value = []
+    qc = qualitycheck.QualityChecker()
+    uploads = []
+    upload = qc._upload
+
+    def slow_upload(filename, prefix):
+        uploads.append(time.monotonic())
+        time.sleep(0.1)
+        upload(filename, prefix=prefix)
+    qc._upload = slow_upload
+    qc._trigger_check = Mock(side_effect=lambda prefix: prefix)
+    qc._watcher = _TimedWatcher(0.5)
+    qc._gitlab = Mock()
+    qc._gitlab.get_pipeline_jobs.return_value = [
+        {"name": "evaluate", "status": "success", "id": 33},
+        {"name": "report", "status": "success", "id": 34}]
+    qc._download_result = Mock()
+    qc._new_prefix = Mock(side_effect=["data/1/", "data/fail/", "data/3/"])
+
+    async def check_all():
+        return await asyncio.gather(*[qc.check_async(filename=str(zipfile)) for _ in range(3)])
+    start = time.monotonic()
+    results = asyncio.run(check_all())
+    duration = time.monotonic() - start
+
+    assert results == [True, False, True]
+    assert max(uploads) < min(qc._watcher.finished)
+    assert duration < 3 * 0.6
+    assert qc._download_result.call_count == 2
+    cleaned = [call.kwargs["Prefix"] for call in
+               mock_s3_client.return_value.get_paginator.return_value.paginate.call_args_list]
+    assert sorted(cleaned) == ["data/1/", "data/3/", "data/fail/"]
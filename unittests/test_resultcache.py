@@ -0,0 +1,65 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from zipfile import ZipFile
+
+from ruqad.resultcache import ResultCache, content_key
+
+
+def _make_eln(path, metadata: str, data: bytes):
+    with ZipFile(path, "w") as zipf:
+        zipf.writestr("export/ro-crate-metadata.json", metadata)
+        zipf.writestr("export/data/table.csv", data)
+    return str(path)
+
+
+def test_content_key(tmp_path):
+    """Only the data members and the version are hashed, not the metadata."""
+    first = _make_eln(tmp_path / "first.eln", '{"exported": 1}', b"a,b\n1,2\n")
+    reexport = _make_eln(tmp_path / "reexport.eln", '{"exported": 2}', b"a,b\n1,2\n")
+    changed = _make_eln(tmp_path / "changed.eln", '{"exported": 1}', b"a,b\n1,3\n")
+
+    assert content_key(first, "1.0") == content_key(reexport, "1.0")
+    assert content_key(first, "1.0") != content_key(changed, "1.0")
+    assert content_key(first, "1.0") != content_key(first, "1.1")
+
+
+def test_result_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_size=25, max_age=100)
+    result = tmp_path / "artifacts.zip"
+    target = tmp_path / "copy.zip"
+
+    assert not cache.get("a", str(target))
+    result.write_bytes(b"x" * 10)
+    cache.put("a", str(result))
+    assert cache.get("a", str(target))
+    assert target.read_bytes() == b"x" * 10
+
+    # Too large: the least recently used entry is evicted.
+    now = time.time()
+    os.utime(tmp_path / "cache" / "a.zip", (now - 10, now - 10))
+    cache.put("b", str(result))
+    os.utime(tmp_path / "cache" / "b.zip", (now - 5, now - 5))
+    cache.get("a", str(target))
+    cache.put("c", str(result))
+    assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == ["a.zip", "c.zip"]
+
+    # Too old
+    cache.evict(now=now + 200)
+    assert list((tmp_path / "cache").iterdir()) == []
@@ -0,0 +1,77 @@
+# Copyright (C) 2024 IndiScale GmbH <info@indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Unit tests for the durable monitor state."""
+
+from datetime import datetime
+
+import sqlite3
+
+import pytest
+
+from ruqad.state import MonitorState
+
+
+def test_resume(tmp_path):
+    filename = str(tmp_path / "state.sqlite")
+    cut_off_date = datetime.fromisoformat("2024-01-02 01:00:00.000000+00:00")
+
+    state = MonitorState(filename)
+    assert state.get_cut_off_date() is None
+    assert state.get_status(1) is None
+    state.set_cut_off_date(cut_off_date)
+    state.set_status(1, "downloaded")
+    state.set_status(1, "crawled")
+    state.set_status(2, "failed")
+    state.close()
+
+    # After a restart, everything is still there.
+    state = MonitorState(filename)
+    assert state.get_cut_off_date() == cut_off_date
+    assert state.get_status(1) == "crawled"
+    assert state.get_status(2) == "failed"
+    assert state.get_status(3) is None
+
+    with pytest.raises(ValueError):
+        state.set_status(3, "done")
+
+
+def test_failed_records(tmp_path):
+    state = MonitorState()
+    state.set_status(1, "failed")
+    state.set_status(2, "failed")
+    state.set_status(2, "failed")
+    state.set_status(3, "crawled")
+    assert [state.get_attempts(rid) for rid in (1, 2, 3, 4)] == [1, 2, 0, 0]
+    assert state.records_with_status("failed") == [1, 2]
+    assert state.records_with_status("failed", max_attempts=2) == [1]
+
+    # A successful retry keeps the count of failed attempts.
+    state.set_status(2, "crawled")
+    assert state.records_with_status("crawled") == [2, 3]
+    assert state.get_attempts(2) == 2
+
+    # State files without the attempts column are extended.
+    filename = str(tmp_path / "old_state.sqlite")
+    with sqlite3.connect(filename) as connection:
+        connection.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, "
+                           "status TEXT NOT NULL, updated_at TEXT NOT NULL)")
+        connection.execute("INSERT INTO records VALUES (5, 'failed', '2024-01-01')")
+    connection.close()
+    state = MonitorState(filename)
+    assert state.records_with_status("failed", max_attempts=1) == [5]
+    state.set_status(5, "failed")
+    assert state.get_attempts(5) == 1
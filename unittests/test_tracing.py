@@ -0,0 +1,77 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+
+import pytest
+
+from ruqad import metrics, tracing
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    yield tmp_path / "trace.json"
+    tracing.configure(None)
+
+
+def test_disabled():
+    assert tracing.trace(1) is tracing.span("stage")
+    with tracing.trace(1):
+        with tracing.span("stage"):
+            pass
+
+
+def test_chrome(trace_file):
+    tracing.configure(str(trace_file))
+    # Spans outside of a trace are ignored.
+    with tracing.span("outside"):
+        pass
+    for rid in (17, 18):
+        with tracing.trace(rid):
+            with metrics.stage("kadi_download"):
+                with tracing.span("kadi_export", attempt=1):
+                    pass
+    # The file is valid at any time, without the closing bracket.
+    events = json.loads(trace_file.read_text().rstrip(",\n") + "]")
+    assert [(event["name"], event["tid"]) for event in events] == [
+        ("kadi_export", 17), ("kadi_download", 17), ("record", 17),
+        ("kadi_export", 18), ("kadi_download", 18), ("record", 18)]
+    assert events[0]["args"] == {"attempt": "1"}
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+
+def test_otlp(trace_file):
+    tracing.configure(str(trace_file), "otlp")
+    with pytest.raises(RuntimeError):
+        with tracing.trace(17):
+            with tracing.span("quality_check"):
+                with tracing.span("pipeline_wait"):
+                    raise RuntimeError("failed")
+    lines = trace_file.read_text().splitlines()
+    assert len(lines) == 1
+    spans = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    by_name = {span["name"]: span for span in spans}
+    assert len({span["traceId"] for span in spans}) == 1
+    assert "parentSpanId" not in by_name["record"]
+    assert by_name["quality_check"]["parentSpanId"] == by_name["record"]["spanId"]
+    assert by_name["pipeline_wait"]["parentSpanId"] == by_name["quality_check"]["spanId"]
+    assert by_name["pipeline_wait"]["status"] == {"code": 2, "message": "RuntimeError: failed"}
+    assert by_name["record"]["attributes"] == [{"key": "record_id",
+                                                "value": {"stringValue": "17"}}]
+
+    with pytest.raises(ValueError):
+        tracing.configure(str(trace_file), "xml")
@@ -0,0 +1,53 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from ruqad import crawler
+from ruqad.crawler_extensions import transformers
+from ruqad.crawler_extensions.transformers import cast_datamodel_type
+
+
+def test_cast_datamodel_type():
+    assert cast_datamodel_type("12.5", {"record_type": "Dataset", "property": "voltage"}) == 12.5
+    assert cast_datamodel_type("3", {"record_type": "Dataset", "property": "rating"}) == 3
+    assert cast_datamodel_type("false", {"record_type": "QualityCheck",
+                                         "property": "FAIRPIDCheck"}) is False
+    # Unknown or untyped properties are not changed.
+    assert cast_datamodel_type("3", {"record_type": "Dataset", "property": "unknown"}) == "3"
+    assert cast_datamodel_type("3", {"record_type": "Dataset", "property": "Author"}) == "3"
+    with pytest.raises(RuntimeError, match="property"):
+        cast_datamodel_type("3", {"record_type": "Dataset"})
+    with pytest.raises(ValueError):
+        cast_datamodel_type("high", {"record_type": "Dataset", "property": "rating"})
+
+
+def test_datamodel_compiled_once(tmp_path):
+    datamodel = tmp_path / "datamodel.yaml"
+    datamodel.write_text("Sample:\n  recommended_properties:\n    weight:\n"
+                         "      datatype: DOUBLE\n")
+    params = {"record_type": "Sample", "property": "weight", "datamodel": str(datamodel)}
+    transformers._datamodel_casts.cache_clear()
+    for value in ("1", "2", "3"):
+        assert cast_datamodel_type(value, params) == float(value)
+    assert transformers._datamodel_casts.cache_info().misses == 1
+
+
+def test_cfood_transformer():
+    _, _, transformer_registry = crawler._load_cfood(
+        str(crawler.ruqad_crawler_settings.joinpath("cfood.yaml")))
+    assert transformer_registry["cast_datamodel_type"] is cast_datamodel_type
@@ -0,0 +1,114 @@
+# This file is a part of the RuQaD project.
+#
+# Copyright (C) 2024 IndiScale GmbH <www.indiscale.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+import http.client
+import json
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from ruqad import metrics
+from ruqad.webhook import RecordQueue, notify, start_webhook_receiver
+
+
+@pytest.fixture
+def receiver():
+    queue = RecordQueue()
+    server = start_webhook_receiver(queue, 0, token="secret")
+    yield queue, f"http://127.0.0.1:{server.server_port}/events"
+    server.shutdown()
+    server.server_close()
+
+
+def _post(url: str, body: bytes, token: str = "secret") -> int:
+    request = Request(url, data=body, method="POST",
+                      headers={"Content-Type": "application/json", "X-Ruqad-Token": token})
+    try:
+        with urlopen(request, timeout=5) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+def test_record_queue():
+    queue = RecordQueue()
+    assert queue.take(timeout=0) == {}
+    queue.put(1)
+    queue.put(2, "record.updated")
+    queue.put(2)
+    queue.put(1)
+    assert len(queue) == 2
+    assert queue.take() == {1: "record.created", 2: "record.updated"}
+
+    # take() returns as soon as a record is notified.
+    threading.Timer(0.05, queue.put, (3,)).start()
+    start = time.monotonic()
+    assert queue.take(timeout=5) == {3: "record.created"}
+    assert time.monotonic() - start < 1
+
+
+def test_receiver(receiver):
+    queue, url = receiver
+    created = metrics.WEBHOOK_EVENTS.value(event="record.created")
+    assert notify(url, 42, token="secret") == [42]
+    assert notify(url, 43, event="record.updated", token="secret") == [43]
+    assert _post(url, json.dumps([{"record_id": 44}, {"record_id": 42}]).encode()) == 202
+    assert queue.take(timeout=0) == {42: "record.created", 43: "record.updated",
+                                     44: "record.created"}
+    assert metrics.WEBHOOK_EVENTS.value(event="record.created") == created + 3
+
+
+def test_receiver_invalid(receiver):
+    queue, url = receiver
+    assert _post(url, json.dumps({"record_id": 42}).encode(), token="wrong") == 401
+    assert _post(url, b"not json") == 400
+    assert _post(url, json.dumps({"record_id": "42"}).encode()) == 400
+    assert _post(url, json.dumps({"record_id": 42, "event": "record.deleted"}).encode()) == 400
+    # Nothing is queued from a partially invalid list.
+    assert _post(url, json.dumps([{"record_id": 42}, {"id": 43}]).encode()) == 400
+    assert _post(url.replace("/events", "/other"), json.dumps({"record_id": 42}).encode()) == 404
+    assert len(queue) == 0
+
+
+@pytest.mark.parametrize("length, status", [(None, 411), ("abc", 400), ("-1", 400),
+                                            (str(10 * 1024 * 1024), 413)])
+def test_receiver_content_length(receiver, length, status):
+    queue, url = receiver
+    connection = http.client.HTTPConnection(url.split("/")[2], timeout=5)
+    connection.putrequest("POST", "/events")
+    connection.putheader("X-Ruqad-Token", "secret")
+    if length is not None:
+        connection.putheader("Content-Length", length)
+    connection.endheaders()
+    assert connection.getresponse().status == status
+    connection.close()
+    assert len(queue) == 0
+
+
+def test_receiver_address():
+    queue = RecordQueue()
+    server = start_webhook_receiver(queue, 0)
+    assert server.server_address[0] == "127.0.0.1"
+    server.shutdown()
+    server.server_close()
+    # Receivers which are reachable from other hosts require a token.
+    for addr in ("", "0.0.0.0", "example.org"):
+        with pytest.raises(ValueError, match="token is required"):
+            start_webhook_receiver(queue, 0, addr=addr)